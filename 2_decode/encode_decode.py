@@ -2,19 +2,43 @@
 """
 Encode or Decode between formats.
 """
+import argparse
+import csv
+import hashlib
+import io
 import json
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import traceback
 import yaml
 # import xml
 import brotli
 import zlib
+import lzma
 import urllib.parse
 import binascii
 from Crypto.Hash import MD5, SHA256, SHA1, SHA512
 from base64 import b64encode, b64decode
 from math import ceil as ceil
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
 import time
 
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def string2bytes(item):
     """
@@ -55,16 +79,86 @@ def hex2string(item):
 
 def hash_format(item):
     """
-    Converts the input to bytes format.
+    Converts the input to bytes format, other buffer protocol objects
+    (bytearray, memoryview, mmap) are returned as a byte memoryview so no copy
+    of the input is made.
     """
     if type(item) == str:
         return string2bytes(item)
     elif type(item) == bytes:
         return item
-    else:
+    try:
+        return memoryview(item).cast('B')
+    except TypeError:
         return None
 
 
+def text_format(item):
+    """
+    Converts the input to bytes format for the parsers that only accept
+    str or bytes (urllib, json, yaml), copying other buffer objects.
+    """
+    formatted_item = hash_format(item)
+    if isinstance(formatted_item, memoryview):
+        return formatted_item.tobytes()
+    return formatted_item
+
+
+def _transcode_into(item, out, function, block_size, aligned_to):
+    formatted_item = hash_format(item)
+    if formatted_item is None:
+        return "Wrong data type expected string or byte, received %s" %\
+               str(type(item).__name__)
+    view = memoryview(formatted_item)
+    output = memoryview(out).cast('B')
+    block_size -= block_size % aligned_to
+    written = 0
+    for pos in range(0, len(view), block_size):
+        data = function(view[pos:pos + block_size])
+        output[written:written + len(data)] = data
+        written += len(data)
+    return written
+
+
+def string2hex_into(item, out, block_size=65536):
+    """
+    Hex encode the input into a caller supplied writable buffer of at least
+    twice the input size, returns the number of bytes written.
+    'A', bytearray(2) -> 2 (bytearray(b'41'))
+    """
+    return _transcode_into(item, out, binascii.hexlify, block_size, 1)
+
+
+def hex2string_into(item, out, block_size=65536):
+    """
+    Hex decode the input into a caller supplied writable buffer of at least
+    half the input size, returns the number of bytes written.
+    '41', bytearray(1) -> 1 (bytearray(b'A'))
+    """
+    return _transcode_into(item, out, binascii.unhexlify, block_size, 2)
+
+
+def string2b64_into(item, out, block_size=49152):
+    """
+    Base64 encode the input into a caller supplied writable buffer of at
+    least 4 * ceil(len / 3) bytes, returns the number of bytes written.
+    'Spartan!!', bytearray(12) -> 12 (bytearray(b'U3BhcnRhbiEh'))
+    """
+    return _transcode_into(
+        item, out, lambda data: binascii.b2a_base64(data, newline=False),
+        block_size, 3)
+
+
+def b642string_into(item, out, block_size=65536):
+    """
+    Base64 decode the input (without line breaks) into a caller supplied
+    writable buffer of at least 3 * len / 4 bytes, returns the number of
+    bytes written.
+    'U3BhcnRhbiEh', bytearray(9) -> 9 (bytearray(b'Spartan!!'))
+    """
+    return _transcode_into(item, out, binascii.a2b_base64, block_size, 4)
+
+
 def string2md5(item):
     """
     Computes the MD5 hash from the input.
@@ -153,13 +247,15 @@ def reverse(item):
     return item[::-1]
 
 
-def string2brotli(item):
+def string2brotli(item, quality=11, lgwin=22, mode=brotli.MODE_GENERIC):
     """
-    Compress string using brotli.
+    Compress string using brotli, quality 0-11, window bits 10-24 and mode
+    MODE_GENERIC, MODE_TEXT or MODE_FONT.
     'A'*100 -> '\x1bc\x00\xf8%\x82\x02\xb1@\xa0\x03'
     """
     formatted_item = hash_format(item)
-    return brotli.compress(formatted_item)
+    return brotli.compress(formatted_item, mode=mode, quality=quality,
+                           lgwin=lgwin)
 
 
 def brotli2string(item):
@@ -171,13 +267,15 @@ def brotli2string(item):
     return brotli.decompress(formatted_item)
 
 
-def string2gzip(item):
+def string2gzip(item, level=-1, wbits=15):
     """
-    Compress string using gzip.
+    Compress string using gzip, level 0-9 (-1 is zlib default 6) and window
+    bits 9-15.
     'A' -> b'x\x9cs\x04\x00\x00B\x00B'
     """
     formatted_item = hash_format(item)
-    return zlib.compress(formatted_item)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(formatted_item) + compressor.flush()
 
 
 def gzip2string(item):
@@ -194,7 +292,7 @@ def string2urlencode(item):
     URL encode string.
     'A B/' -> 'A+B%2F'
     """
-    formatted_item = hash_format(item)
+    formatted_item = text_format(item)
     return urllib.parse.quote_plus(formatted_item)
 
 
@@ -203,7 +301,7 @@ def urldecode2string(item):
     Decode URL encoded into string.
     'A+B%2F' -> 'A B/'
     """
-    formatted_item = hash_format(item)
+    formatted_item = text_format(item)
     return urllib.parse.unquote_plus(formatted_item)
 
 
@@ -212,17 +310,17 @@ def urldecode2bytes(item):
     Decode URL encoded into bytes.
     'A+B%2F' -> b'A+B/'
     """
-    formatted_item = hash_format(item)
+    formatted_item = text_format(item)
     return urllib.parse.unquote_plus(formatted_item)
 
 
-def json2yaml(item):
+def json2yaml(item, Dumper=yaml.Dumper):
     """
     Convert JSON into YAML.
     '{"a": {"b": 1, "c": [2, 3]}}' ->  'a:\n  b: 1\n  c:\n  - 2\n  - 3\n'
     """
-    formatted_item = hash_format(item)
-    return yaml.dump(json.loads(formatted_item))
+    formatted_item = text_format(item)
+    return yaml.dump(json.loads(formatted_item), Dumper=Dumper)
 
 
 def yaml2json(item, Loader=yaml.SafeLoader):
@@ -230,10 +328,74 @@ def yaml2json(item, Loader=yaml.SafeLoader):
     Convert YAML into JSON.
     'a:\n  b: 1\n  c:\n  - 2\n  - 3\n' -> '{"a": {"b": 1, "c": [2, 3]}}'
     """
-    formatted_item = hash_format(item)
+    formatted_item = text_format(item)
     return json.dumps(yaml.load(formatted_item, Loader=Loader))
 
 
+def yaml2jsonl(source, destination, Loader=YamlLoader):
+    """
+    Convert a multi-document YAML file into JSON Lines one document at a time,
+    uses the libyaml C loader when available. Source and destination can be
+    paths or file objects, returns the number of documents written.
+    'a: 1\n---\nb: 2\n' -> '{"a": 1}\n{"b": 2}\n'
+    """
+    if not hasattr(source, 'read'):
+        with open(source, 'rb') as f:
+            return yaml2jsonl(f, destination, Loader)
+    if not hasattr(destination, 'write'):
+        with open(destination, 'w') as f:
+            return yaml2jsonl(source, f, Loader)
+    count = 0
+    for document in yaml.load_all(source, Loader=Loader):
+        destination.write(json.dumps(document) + '\n')
+        count += 1
+    return count
+
+
+def jsonl2yaml(source, destination, Dumper=YamlDumper):
+    """
+    Convert JSON Lines into a multi-document YAML file one record at a time,
+    uses the libyaml C dumper when available. Source and destination can be
+    paths or file objects, returns the number of documents written.
+    '{"a": 1}\n{"b": 2}\n' -> '---\na: 1\n---\nb: 2\n'
+    """
+    if not hasattr(source, 'read'):
+        with open(source, 'rb') as f:
+            return jsonl2yaml(f, destination, Dumper)
+    if not hasattr(destination, 'write'):
+        with open(destination, 'w') as f:
+            return jsonl2yaml(source, f, Dumper)
+    count = 0
+    for line in source:
+        if not line.strip():
+            continue
+        yaml.dump(json.loads(line), destination, Dumper=Dumper,
+                  explicit_start=True)
+        count += 1
+    return count
+
+
+def yaml_benchmark(documents=20000):
+    """
+    Compare yaml2json with the pure Python loader against the libyaml
+    streaming path on a generated multi-document inventory, in seconds.
+    yaml_benchmark() -> {'yaml2json': 15.1, 'yaml2jsonl': 1.9, 'libyaml': True}
+    """
+    record = {'host': '10.0.0.1', 'ports': [22, 80, 443],
+              'tags': {'owner': 'spartan', 'env': 'prod'}}
+    payload = yaml.dump_all([dict(record, id=i) for i in range(documents)],
+                            Dumper=YamlDumper)
+    start = time.perf_counter()
+    [json.dumps(d) for d in yaml.load_all(payload, Loader=yaml.SafeLoader)]
+    pure_time = time.perf_counter() - start
+    start = time.perf_counter()
+    yaml2jsonl(io.StringIO(payload), io.StringIO())
+    stream_time = time.perf_counter() - start
+    return {'yaml2json': round(pure_time, 3),
+            'yaml2jsonl': round(stream_time, 3),
+            'libyaml': YamlLoader is not yaml.SafeLoader}
+
+
 def stringxor(item, key):
     """
     String XOR with key, if the key is shorter it will be repeated multiple
@@ -252,6 +414,82 @@ def stringxor(item, key):
     xor = [chr(ord(p) ^ ord(k)) for p, k in zip(payload, key_stream)]
     return ''.join(xor)
 
+
+XOR_BLOCK_SIZE = 1024 * 1024
+
+
+def bytesxor(item, key, offset=0):
+    """
+    Bytes XOR with key over whole buffers, if the key is shorter it will be
+    repeated to match the length of the payload. Accepts bytes, bytearray,
+    memoryview or str (utf-8), offset is the position in the key to start at.
+    b'ABC', b'A' -> b'\x00\x03\x02'
+    """
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        data = memoryview(item).cast('B')
+    else:
+        data = hash_format(item)
+    formatted_key = hash_format(key) if not isinstance(
+        key, (bytearray, memoryview)) else bytes(key)
+    if data is None or not formatted_key:
+        return "Wrong data type expected string or byte, received %s" %\
+               str(type(item if data is None else key).__name__)
+    if not len(data):
+        return b''
+    key_len = len(formatted_key)
+    offset %= key_len
+    formatted_key = formatted_key[offset:] + formatted_key[:offset]
+    block = min(XOR_BLOCK_SIZE - XOR_BLOCK_SIZE % key_len or key_len,
+                len(data))
+    key_block = (formatted_key * ceil(block / key_len))[:block]
+    key_int = int.from_bytes(key_block, 'little')
+    output = []
+    for pos in range(0, len(data), block):
+        segment = data[pos:pos + block]
+        size = len(segment)
+        if size != block:
+            key_int = int.from_bytes(key_block[:size], 'little')
+        output.append((int.from_bytes(segment, 'little') ^ key_int).to_bytes(
+            size, 'little'))
+    return b''.join(output)
+
+
+def stream_xor(chunks, key):
+    """
+    XOR a stream of chunks with key, the key offset is carried across chunks
+    so the output matches bytesxor over the whole payload, str chunks advance
+    it by their utf-8 length.
+    """
+    formatted_key = hash_format(key)
+    if not formatted_key:
+        raise ValueError("XOR key must be a non empty string or bytes")
+    offset = 0
+    key_len = len(formatted_key)
+    for chunk in chunks:
+        yield bytesxor(chunk, key, offset)
+        offset = (offset + len(hash_format(chunk) or b'')) % key_len
+
+
+def xor_benchmark(size=100 * 1024 * 1024, key=b'spartan!',
+                  sample_size=1024 * 1024):
+    """
+    Compare stringxor and bytesxor throughput in MB/s on random data.
+    stringxor is only timed on sample_size bytes as it is too slow for
+    large inputs.
+    xor_benchmark() -> {'stringxor': 2.1, 'bytesxor': 210.4, 'speedup': 100.2}
+    """
+    payload = os.urandom(size)
+    sample = payload[:sample_size].decode('latin-1')
+    start = time.perf_counter()
+    stringxor(sample, key.decode('latin-1'))
+    string_rate = len(sample) / (time.perf_counter() - start) / 2 ** 20
+    start = time.perf_counter()
+    bytesxor(payload, key)
+    bytes_rate = size / (time.perf_counter() - start) / 2 ** 20
+    return {'stringxor': round(string_rate, 1),
+            'bytesxor': round(bytes_rate, 1),
+            'speedup': round(bytes_rate / string_rate, 1)}
+
 def human_readable_time(seconds):
     """
     Convert duration in seconds to a human readable format.
@@ -265,4 +503,838 @@ def human_readable_time(seconds):
         amount, seconds = divmod(int(seconds), div)
         if amount > 0:
             parts.append('{} {}{}'.format(amount, unit, "" if amount == 1 else "s"))
-    return ', '.join(parts)
\ No newline at end of file
+    return ', '.join(parts)
+
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+}
+B64_IGNORED = b' \t\r\n\x0b\x0c'
+# brotli >= 1.2 can cap the output of a single process() call
+BROTLI_OUTPUT_LIMIT = 'output_buffer_limit' in (
+    brotli.Decompressor.process.__doc__ or '')
+BROTLI_INPUT_SLICE_SIZE = 1024
+
+
+def stream_chunks(source, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield bytes chunks from a file object, a str/bytes payload, a buffer
+    object (sliced as zero copy memoryviews) or an iterable of chunks.
+    open('dump.db', 'rb') -> b'...', b'...', ...
+    """
+    if isinstance(source, (str, bytes, bytearray, memoryview, mmap.mmap)):
+        formatted_item = hash_format(source)
+        for pos in range(0, len(formatted_item), chunk_size):
+            yield formatted_item[pos:pos + chunk_size]
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield hash_format(chunk)
+    else:
+        for chunk in source:
+            formatted_chunk = hash_format(chunk)
+            if formatted_chunk is None:
+                raise TypeError("Wrong data type expected string or byte, "
+                                "received %s" % str(type(chunk).__name__))
+            if formatted_chunk:
+                yield formatted_chunk
+
+
+def stream_pipeline(source, *stages, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Chain streaming stages over a source, each stage takes an iterator of
+    bytes chunks and yields bytes chunks.
+    stream_pipeline(f, stream_brotli2string, stream_b642string)
+    """
+    chunks = stream_chunks(source, chunk_size)
+    for stage in stages:
+        chunks = stage(chunks)
+    return chunks
+
+
+def stream_string2gzip(chunks, level=-1):
+    """
+    Compress a stream of chunks using gzip (zlib format, as string2gzip).
+    """
+    compressor = zlib.compressobj(level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_gzip2string(chunks, max_length=STREAM_CHUNK_SIZE):
+    """
+    Decompress a stream of gzip (zlib format) chunks, output is produced in
+    blocks of at most max_length bytes. A truncated stream raises zlib.error.
+    """
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        data = chunk
+        while data:
+            output = decompressor.decompress(data, max_length)
+            if output:
+                yield output
+            data = decompressor.unconsumed_tail
+    output = decompressor.flush()
+    if output:
+        yield output
+    if not decompressor.eof:
+        raise zlib.error("Truncated gzip stream")
+
+
+def stream_string2brotli(chunks, quality=11):
+    """
+    Compress a stream of chunks using brotli.
+    """
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def stream_brotli2string(chunks, max_length=STREAM_CHUNK_SIZE):
+    """
+    Decompress a stream of brotli chunks, output is produced in blocks of
+    at most max_length bytes. A truncated stream raises brotli.error.
+    """
+    decompressor = brotli.Decompressor()
+    for chunk in chunks:
+        if BROTLI_OUTPUT_LIMIT:
+            pending = [chunk]
+        else:
+            # without an output limit bound the input fed per call instead
+            view = memoryview(chunk)
+            pending = [view[pos:pos + BROTLI_INPUT_SLICE_SIZE] for pos in
+                       range(0, len(view), BROTLI_INPUT_SLICE_SIZE)]
+        for data in pending:
+            while True:
+                if BROTLI_OUTPUT_LIMIT:
+                    output = decompressor.process(
+                        data, output_buffer_limit=max_length)
+                else:
+                    output = decompressor.process(data)
+                data = b''
+                for pos in range(0, len(output), max_length):
+                    yield output[pos:pos + max_length]
+                if decompressor.can_accept_more_data():
+                    break
+    # drain output still held back by the limit once the input is consumed
+    while BROTLI_OUTPUT_LIMIT and not decompressor.is_finished():
+        output = decompressor.process(b'', output_buffer_limit=max_length)
+        if not output:
+            break
+        for pos in range(0, len(output), max_length):
+            yield output[pos:pos + max_length]
+    if not decompressor.is_finished():
+        raise brotli.error("Truncated brotli stream")
+
+
+def stream_string2b64(chunks):
+    """
+    Encode a stream of chunks in base64, chunks are re-aligned to multiples
+    of 3 bytes so the output matches string2b64.
+    """
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk
+        aligned = len(data) - len(data) % 3
+        pending = data[aligned:]
+        if aligned:
+            yield b64encode(data[:aligned])
+    if pending:
+        yield b64encode(pending)
+
+
+def stream_b642string(chunks):
+    """
+    Decode a stream of base64 chunks, whitespace and line breaks are ignored
+    and chunks are re-aligned to multiples of 4 characters.
+    """
+    pending = b''
+    for chunk in chunks:
+        data = (pending + chunk).translate(None, B64_IGNORED)
+        aligned = len(data) - len(data) % 4
+        pending = data[aligned:]
+        if aligned:
+            yield b64decode(data[:aligned])
+    if pending:
+        yield b64decode(pending)
+
+
+def stream_string2hex(chunks):
+    """
+    Convert a stream of chunks to hex.
+    """
+    for chunk in chunks:
+        yield binascii.hexlify(chunk)
+
+
+def stream_hex2string(chunks):
+    """
+    Convert a stream of hex chunks to bytes, whitespace and line breaks
+    (xxd -p output) are ignored and chunks are re-aligned to an even number
+    of characters.
+    """
+    pending = b''
+    for chunk in chunks:
+        data = (pending + chunk).translate(None, B64_IGNORED)
+        aligned = len(data) - len(data) % 2
+        pending = data[aligned:]
+        if aligned:
+            yield binascii.unhexlify(data[:aligned])
+    if pending:
+        raise binascii.Error("Odd-length hex stream")
+
+
+TRANSCODE_BLOCK_SIZE = 3 * 1024 * 1024
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def _transcode_file(source, destination, stage, block_size):
+    with open(source, 'rb') as f, \
+            open(destination, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        if not os.fstat(f.fileno()).st_size:
+            return stream_to_file(stage(iter(())), out)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            chunks = stage(stream_chunks(m, block_size))
+            try:
+                return stream_to_file(chunks, out)
+            except Exception as error:
+                # the traceback frames hold memoryviews of the map, release
+                # them or closing the map fails with BufferError
+                chunks.close()
+                traceback.clear_frames(error.__traceback__)
+                raise
+
+
+def string2b64_file(source, destination, block_size=TRANSCODE_BLOCK_SIZE):
+    """
+    Base64 encode a file into another file, the input is memory mapped and
+    processed in blocks, returns the number of bytes written.
+    'dump.bin', 'dump.b64' -> 1398104
+    """
+    return _transcode_file(source, destination, stream_string2b64,
+                           block_size)
+
+
+def b642string_file(source, destination, block_size=TRANSCODE_BLOCK_SIZE):
+    """
+    Base64 decode a file into another file, line breaks and whitespace in
+    the input are skipped per block, returns the number of bytes written.
+    'mime.b64', 'attachment.bin' -> 1048576
+    """
+    return _transcode_file(source, destination, stream_b642string,
+                           block_size)
+
+
+def string2hex_file(source, destination, block_size=TRANSCODE_BLOCK_SIZE):
+    """
+    Hex encode a file into another file, returns the number of bytes written.
+    'dump.bin', 'dump.hex' -> 2097152
+    """
+    return _transcode_file(source, destination, stream_string2hex,
+                           block_size)
+
+
+def hex2string_file(source, destination, block_size=TRANSCODE_BLOCK_SIZE):
+    """
+    Hex decode a file into another file, whitespace and line breaks in the
+    input are skipped, returns the number of bytes written.
+    'dump.hex', 'dump.bin' -> 1048576
+    """
+    return _transcode_file(source, destination, stream_hex2string,
+                           block_size)
+
+
+def stream_hash(chunks, algorithm='sha256'):
+    """
+    Compute a hash over a stream of chunks and return the hex digest.
+    stream_hash(stream_pipeline(f, stream_b642string), 'sha256') -> '...'
+    """
+    hash_obj = HASH_ALGORITHMS[algorithm]()
+    for chunk in chunks:
+        hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+def multi_hash(source, algorithms=('md5', 'sha1', 'sha256', 'sha512'),
+               chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Compute several hashes reading the source only once. The source can be a
+    str/bytes payload or buffer object (always hashed as data, never looked
+    up as a file name), a binary file object or an os.PathLike path, every
+    chunk read is fed to all the hash objects from the same buffer.
+    'A' -> {'md5': '7fc5...', 'sha1': '6dcd...', 'sha256': '559a...', ...}
+    """
+    hash_objs = {a: HASH_ALGORITHMS[a]() for a in algorithms}
+    if isinstance(source, (str, bytes, bytearray, memoryview, mmap.mmap)):
+        formatted_item = hash_format(source)
+        for hash_obj in hash_objs.values():
+            hash_obj.update(formatted_item)
+    elif hasattr(source, 'readinto'):
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            size = source.readinto(buffer)
+            if not size:
+                break
+            for hash_obj in hash_objs.values():
+                hash_obj.update(view[:size])
+    elif hasattr(source, 'read'):
+        for chunk in stream_chunks(source, chunk_size):
+            for hash_obj in hash_objs.values():
+                hash_obj.update(chunk)
+    elif isinstance(source, os.PathLike):
+        return multi_hash_file(source, algorithms, chunk_size)
+    else:
+        raise TypeError("Wrong data type expected string, byte, file or "
+                        "path, received %s" % str(type(source).__name__))
+    return {a: h.hexdigest() for a, h in hash_objs.items()}
+
+
+def multi_hash_file(path, algorithms=('md5', 'sha1', 'sha256', 'sha512'),
+                    chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Compute several hashes of the file at path reading it only once.
+    'evidence/a.bin' -> {'md5': '...', 'sha1': '...', ...}
+    """
+    with open(path, 'rb', buffering=0) as f:
+        return multi_hash(f, algorithms, chunk_size)
+
+
+def multi_hash_files(paths, algorithms=('md5', 'sha1', 'sha256', 'sha512'),
+                     workers=4, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Compute several hashes for many files at once using a thread pool, the
+    hash updates on large chunks release the GIL.
+    ['a.bin', 'b.bin'] -> {'a.bin': {'md5': ...}, 'b.bin': {'md5': ...}}
+    """
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(
+            lambda path: multi_hash_file(path, algorithms, chunk_size),
+            paths)
+        return dict(zip(paths, digests))
+
+
+def _walk_files(root, exclude=()):
+    """
+    Yield (path, stat) for every regular file below root without following
+    symlinks, stat is the OSError instead for entries that could not be
+    read. Files whose (st_dev, st_ino) is in exclude are skipped.
+    """
+    try:
+        entries = os.scandir(root)
+    except OSError as error:
+        yield root, error
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _walk_files(entry.path, exclude)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if (st.st_dev, st.st_ino) in exclude:
+                        continue
+                    yield entry.path, st
+            except OSError as error:
+                yield entry.path, error
+
+
+HASH_CACHE_BATCH_SIZE = 1000
+
+
+def hash_directory(root, manifest=None, cache='.hash_cache.sqlite',
+                   algorithms=('md5', 'sha1', 'sha256', 'sha512'), workers=4,
+                   chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Hash every file below root using a thread pool. Digests are cached in a
+    SQLite database keyed by (inode, size, mtime_ns) so unchanged files are
+    not read again on later runs, new digests are committed in batches as
+    they are computed. Files that cannot be read get an 'error' field
+    instead of digests, the cache and manifest files are never hashed. If
+    manifest is given the records are written as JSON Lines, or as CSV
+    when the name ends with '.csv'.
+    'evidence/' -> [{'path': 'evidence/a.bin', 'size': 3, 'mtime_ns': ...,
+                     'md5': ..., 'sha1': ..., 'sha256': ..., 'sha512': ...}]
+    """
+    algorithms = tuple(algorithms)
+    algorithms_key = ','.join(algorithms)
+    db = sqlite3.connect(cache)
+    db.execute("CREATE TABLE IF NOT EXISTS digests (inode INTEGER, "
+               "size INTEGER, mtime_ns INTEGER, algorithms TEXT, "
+               "digests TEXT, PRIMARY KEY (inode, size, mtime_ns, "
+               "algorithms))")
+    cached = {row[:3]: row[3] for row in db.execute(
+        "SELECT inode, size, mtime_ns, digests FROM digests "
+        "WHERE algorithms = ?", (algorithms_key,))}
+    exclude = set()
+    for path in (cache, cache + '-journal', cache + '-wal', manifest):
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            continue
+        if st:
+            exclude.add((st.st_dev, st.st_ino))
+    records = []
+    missing = []
+    for path, st in _walk_files(root, exclude):
+        if isinstance(st, OSError):
+            records.append({'path': path, 'size': None, 'mtime_ns': None,
+                            'error': str(st)})
+            continue
+        record = {'path': path, 'size': st.st_size,
+                  'mtime_ns': st.st_mtime_ns}
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if key in cached:
+            record.update(json.loads(cached[key]))
+        else:
+            missing.append((key, record))
+        records.append(record)
+
+    def hash_file(item):
+        try:
+            return multi_hash_file(item[1]['path'], algorithms, chunk_size)
+        except OSError as error:
+            return error
+
+    rows = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = executor.map(hash_file, missing)
+            for (key, record), digest in zip(missing, digests):
+                if isinstance(digest, OSError):
+                    record['error'] = str(digest)
+                    continue
+                record.update(digest)
+                rows.append(key + (algorithms_key, json.dumps(digest)))
+                if len(rows) >= HASH_CACHE_BATCH_SIZE:
+                    db.executemany("INSERT OR REPLACE INTO digests VALUES "
+                                   "(?, ?, ?, ?, ?)", rows)
+                    db.commit()
+                    rows = []
+    finally:
+        db.executemany("INSERT OR REPLACE INTO digests VALUES "
+                       "(?, ?, ?, ?, ?)", rows)
+        db.commit()
+        db.close()
+    if manifest:
+        with open(manifest, 'w', newline='') as f:
+            if manifest.endswith('.csv'):
+                writer = csv.DictWriter(
+                    f, fieldnames=['path', 'size', 'mtime_ns'] +
+                    list(algorithms) + ['error'])
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                f.writelines(json.dumps(r) + '\n' for r in records)
+    return records
+
+
+def stream_to_file(chunks, destination):
+    """
+    Write a stream of chunks to a file object or path, returns the number of
+    bytes written.
+    """
+    if hasattr(destination, 'write'):
+        written = 0
+        for chunk in chunks:
+            destination.write(chunk)
+            written += len(chunk)
+        return written
+    with open(destination, 'wb') as f:
+        return stream_to_file(chunks, f)
+
+
+
+B64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+HEX_ALPHABET = b'0123456789abcdefABCDEF'
+PRINTABLE = bytes(range(32, 127)) + b'\t\r\n'
+URLENCODED_RE = re.compile(rb'%[0-9A-Fa-f]{2}')
+AUTO_DECODE_MAX_SIZE = 256 * 1024 * 1024
+AUTO_DECODE_SLICE_SIZE = 4096
+
+
+def _looks_b64(data):
+    stripped = data.translate(None, B64_IGNORED)
+    body = stripped.rstrip(b'=')
+    return (len(body) >= 4 and len(body) % 4 != 1 and
+            len(stripped) - len(body) <= 2 and
+            not body.translate(None, B64_ALPHABET))
+
+
+def _looks_hex(data):
+    return (len(data) >= 2 and len(data) % 2 == 0 and
+            not data.translate(None, HEX_ALPHABET))
+
+
+def _looks_zlib(data):
+    return len(data) >= 2 and (data[:2] == b'\x1f\x8b' or (
+        data[0] & 0x0f == 8 and ((data[0] << 8) | data[1]) % 31 == 0))
+
+
+def _looks_brotli(data):
+    try:
+        brotli.Decompressor().process(data[:256])
+        return bool(data)
+    except brotli.error:
+        return False
+
+
+def _looks_urlencoded(data):
+    return (URLENCODED_RE.search(data) is not None and
+            printable_ratio(data) == 1)
+
+
+def _looks_reversed(data):
+    reversed_data = data[::-1]
+    return any(check(reversed_data) for name, (check, decode)
+               in AUTO_DECODERS.items() if name != 'reverse')
+
+
+def _decode_b64(data):
+    stripped = data.translate(None, B64_IGNORED).rstrip(b'=')
+    return b64decode(stripped + b'=' * (-len(stripped) % 4), validate=True)
+
+
+def _decode_zlib(data):
+    decompressor = zlib.decompressobj(47)
+    output = decompressor.decompress(data, AUTO_DECODE_MAX_SIZE)
+    if decompressor.unconsumed_tail:
+        raise zlib.error("Decompressed layer exceeds %d bytes" %
+                         AUTO_DECODE_MAX_SIZE)
+    return output
+
+
+def _decode_brotli(data):
+    output = []
+    size = 0
+    for block in stream_brotli2string([data], AUTO_DECODE_SLICE_SIZE * 16):
+        size += len(block)
+        if size > AUTO_DECODE_MAX_SIZE:
+            raise brotli.error("Decompressed layer exceeds %d bytes" %
+                               AUTO_DECODE_MAX_SIZE)
+        output.append(block)
+    return b''.join(output)
+
+
+def _decode_url(data):
+    return urllib.parse.unquote_to_bytes(data.replace(b'+', b' '))
+
+
+AUTO_DECODERS = {
+    'b642string': (_looks_b64, _decode_b64),
+    'gzip2string': (_looks_zlib, _decode_zlib),
+    'brotli2string': (_looks_brotli, _decode_brotli),
+    'hex2string': (_looks_hex, binascii.unhexlify),
+    'urldecode2string': (_looks_urlencoded, _decode_url),
+    'reverse': (_looks_reversed, reverse),
+}
+
+
+def _looks_encoded(data):
+    return any(check(data) for check in
+               (_looks_b64, _looks_hex, _looks_zlib, _looks_urlencoded))
+
+
+def printable_ratio(item, sample_size=4096):
+    """
+    Ratio of printable ASCII characters sampled from the start and the end of
+    the input.
+    b'ABC\x00' -> 0.75
+    """
+    formatted_item = hash_format(item)
+    if len(formatted_item) > sample_size:
+        sample = (formatted_item[:sample_size // 2] +
+                  formatted_item[-(sample_size // 2):])
+    else:
+        sample = bytes(formatted_item)
+    if not sample:
+        return 0.0
+    return 1 - len(sample.translate(None, PRINTABLE)) / len(sample)
+
+
+def auto_decode(blob, max_depth=6, max_layers=1000):
+    """
+    Explore decode chains (base64, gzip, brotli, hex, url, reverse) over the
+    blob breadth first. Each decoder is only attempted when a cheap check on
+    the layer passes (alphabet, magic bytes, brotli prefix) and every layer is
+    memoized by digest so it is never decoded twice. Returns the candidate
+    chains ranked by printable ratio, minus 0.5 for layers that still look
+    encoded or that decode further (including through a reverse), and
+    shorter chains first on ties. Chains ending in a reverse are only kept
+    as intermediate layers.
+    'eJxzdAIAAMYAhA==' -> [{'chain': ['b642string', 'gzip2string'],
+                          'score': 0.5, 'data': b'AB'}, ...]
+    """
+    formatted_item = text_format(blob)
+    seen = {SHA1.new(formatted_item).digest()}
+    layer = [((), formatted_item)]
+    candidates = []
+    parents = set()
+    for depth in range(max_depth):
+        next_layer = []
+        for chain, data in layer:
+            for name, (check, decode) in AUTO_DECODERS.items():
+                if chain and chain[-1] == name == 'reverse':
+                    continue
+                if not check(data):
+                    continue
+                try:
+                    decoded = decode(data)
+                except (binascii.Error, zlib.error, brotli.error, ValueError):
+                    continue
+                if not decoded or len(decoded) > AUTO_DECODE_MAX_SIZE:
+                    continue
+                digest = SHA1.new(decoded).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                parents.add(chain)
+                next_layer.append((chain + (name,), decoded))
+                if len(seen) > max_layers:
+                    break
+        candidates += [c for c in next_layer if c[0][-1] != 'reverse']
+        layer = next_layer
+        if not layer or len(seen) > max_layers:
+            break
+    scored = [{'chain': list(chain),
+               'score': round(printable_ratio(data) - 0.5 * (
+                   chain in parents or _looks_encoded(data)), 3),
+               'data': data} for chain, data in candidates]
+    return sorted(scored, key=lambda c: (-c['score'], len(c['chain'])))
+
+
+
+COMPRESSION_BACKENDS = {
+    'gzip': (lambda data, level: string2gzip(data, level), zlib.decompress,
+             range(1, 10)),
+    'brotli': (lambda data, level: string2brotli(data, level),
+               brotli.decompress, range(0, 12)),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level),
+             lzma.decompress, range(0, 10)),
+}
+if zstandard:
+    COMPRESSION_BACKENDS['zstd'] = (
+        lambda data, level: zstandard.ZstdCompressor(level=level).compress(
+            data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+        range(1, 20))
+
+
+def compress(item, backend='brotli', level=None):
+    """
+    Compress the input with one of the COMPRESSION_BACKENDS (gzip, brotli,
+    lzma and zstd when installed), level None uses the highest level.
+    'A'*100, 'gzip', 9 -> b'x\xdast\xa4=\x00\x00\x02\xe9\x19e'
+    """
+    formatted_item = hash_format(item)
+    compressor, decompressor, levels = COMPRESSION_BACKENDS[backend]
+    return compressor(formatted_item, levels[-1] if level is None else level)
+
+
+def decompress(item, backend='brotli'):
+    """
+    Decompress the input with one of the COMPRESSION_BACKENDS.
+    """
+    formatted_item = hash_format(item)
+    return COMPRESSION_BACKENDS[backend][1](formatted_item)
+
+
+def compression_benchmark(sample, backends=None, levels=None):
+    """
+    Measure ratio, compress MB/s and decompress MB/s of every backend and
+    level on a sample of the data to be compressed.
+    open('scan.db', 'rb').read(2**24) -> [{'backend': 'gzip', 'level': 1,
+        'ratio': 3.1, 'compress_mbps': 95.2, 'decompress_mbps': 410.7}, ...]
+    """
+    formatted_item = hash_format(sample)
+    size = len(formatted_item) / 2 ** 20
+    results = []
+    for backend in backends or COMPRESSION_BACKENDS:
+        compressor, decompressor, backend_levels = \
+            COMPRESSION_BACKENDS[backend]
+        for level in (levels or {}).get(backend, backend_levels):
+            start = time.perf_counter()
+            compressed = compressor(formatted_item, level)
+            compress_time = time.perf_counter() - start
+            start = time.perf_counter()
+            decompressor(compressed)
+            decompress_time = time.perf_counter() - start
+            results.append({
+                'backend': backend,
+                'level': level,
+                'ratio': round(len(formatted_item) / max(len(compressed), 1),
+                               3),
+                'compress_mbps': round(size / max(compress_time, 1e-9), 1),
+                'decompress_mbps': round(size / max(decompress_time, 1e-9), 1),
+            })
+    return results
+
+
+def auto_compression(sample, min_compress_mbps=None, min_ratio=None,
+                     backends=None):
+    """
+    Pick the backend and level for a throughput or ratio budget from a
+    benchmark on a sample. With min_compress_mbps the best ratio at that
+    speed is chosen, with min_ratio the fastest setting reaching that ratio.
+    sample, min_compress_mbps=50 -> {'backend': 'brotli', 'level': 5, ...}
+    """
+    results = compression_benchmark(sample, backends)
+    if min_compress_mbps is not None:
+        results = [r for r in results
+                   if r['compress_mbps'] >= min_compress_mbps]
+    if min_ratio is not None:
+        results = [r for r in results if r['ratio'] >= min_ratio]
+        return max(results, key=lambda r: r['compress_mbps'], default=None)
+    return max(results, key=lambda r: r['ratio'], default=None)
+
+
+
+Codec = namedtuple('Codec', ['name', 'input', 'output', 'function'])
+CODECS = {c.name: c for c in [
+    Codec('b64', 'bytes', 'text',
+          lambda data: binascii.b2a_base64(data, newline=False)),
+    Codec('b64d', 'text', 'bytes', binascii.a2b_base64),
+    Codec('hex', 'bytes', 'text', binascii.hexlify),
+    Codec('hexd', 'text', 'bytes', binascii.unhexlify),
+    Codec('gz', 'bytes', 'bytes', zlib.compress),
+    Codec('gzd', 'bytes', 'bytes', zlib.decompress),
+    Codec('br', 'bytes', 'bytes', brotli.compress),
+    Codec('brd', 'bytes', 'bytes', brotli.decompress),
+    Codec('url', 'bytes', 'text',
+          lambda data: urllib.parse.quote_plus(data).encode()),
+    Codec('urld', 'text', 'bytes', _decode_url),
+    Codec('rev', 'bytes', 'bytes', reverse),
+    Codec('md5', 'bytes', 'text',
+          lambda data: hashlib.md5(data).hexdigest().encode()),
+    Codec('sha1', 'bytes', 'text',
+          lambda data: hashlib.sha1(data).hexdigest().encode()),
+    Codec('sha256', 'bytes', 'text',
+          lambda data: hashlib.sha256(data).hexdigest().encode()),
+    Codec('sha512', 'bytes', 'text',
+          lambda data: hashlib.sha512(data).hexdigest().encode()),
+]}
+
+
+def get_chain(spec):
+    """
+    Resolve a comma separated list of codec names into their functions.
+    'b64d,gzd,sha256' -> [<b64d>, <gzd>, <sha256>]
+    """
+    names = spec.split(',') if isinstance(spec, str) else spec
+    unknown = [n for n in names if n not in CODECS]
+    if unknown:
+        raise KeyError("Unknown codec %s, available: %s" % (
+            ','.join(unknown), ','.join(CODECS)))
+    return [CODECS[n].function for n in names]
+
+
+def apply_chain(item, chain):
+    """
+    Apply a codec chain to bytes, raises the codec errors.
+    b'eJxzdAIAAMYAhA==', 'b64d,gzd' -> b'AB'
+    """
+    if isinstance(chain, str):
+        chain = get_chain(chain)
+    for function in chain:
+        item = function(item)
+    return item
+
+
+def _apply_batch(spec, records):
+    chain = get_chain(spec)
+    output = []
+    errors = 0
+    for record in records:
+        try:
+            output.append(apply_chain(record, chain))
+        except Exception:
+            output.append(b'')
+            errors += 1
+    return output, errors
+
+
+def _read_records(stream, delimiter, batch_size, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield batches of delimited records, in newline mode the CR of CRLF line
+    endings is dropped from every record.
+    """
+    crlf = delimiter == b'\n'
+    batch = []
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        records = (pending + chunk).split(delimiter)
+        pending = records.pop()
+        if crlf:
+            records = [r[:-1] if r.endswith(b'\r') else r for r in records]
+        batch += records
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if pending:
+        batch.append(pending[:-1] if crlf and pending.endswith(b'\r')
+                     else pending)
+    if batch:
+        yield batch
+
+
+def main(argv=None):
+    """
+    Apply a codec chain to every newline or NUL delimited record read from
+    stdin and write the results to stdout with the same delimiter. Records
+    that fail to decode are written empty and counted on stderr.
+    printf 'eJxzdAIAAMYAhA==\n' | encode_decode.py b64d,gzd -> AB
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('chain', help="comma separated codecs: %s" %
+                        ','.join(CODECS))
+    parser.add_argument('-0', '--null', action='store_true',
+                        help="records are NUL delimited")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="worker processes")
+    parser.add_argument('-b', '--batch-size', type=int, default=10000,
+                        help="records per batch")
+    args = parser.parse_args(argv)
+    try:
+        get_chain(args.chain)
+    except KeyError as error:
+        parser.error(error.args[0])
+    delimiter = b'\0' if args.null else b'\n'
+    batches = _read_records(sys.stdin.buffer, delimiter, args.batch_size)
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap(partial(_apply_batch, args.chain), batches)
+    else:
+        pool = None
+        results = (_apply_batch(args.chain, b) for b in batches)
+    errors = 0
+    for output, batch_errors in results:
+        sys.stdout.buffer.write(delimiter.join(output) + delimiter)
+        errors += batch_errors
+    sys.stdout.buffer.flush()
+    if pool:
+        pool.close()
+        pool.join()
+    if errors:
+        print("%d records failed" % errors, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
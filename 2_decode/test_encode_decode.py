@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Memory profiling tests for the zero copy buffer paths of encode_decode.
+"""
+import mmap
+import os
+import tempfile
+import tracemalloc
+import unittest
+
+import encode_decode
+
+SIZE = 8 * 1024 * 1024
+# far below SIZE, a copy of the input would exceed it
+MAX_PEAK = 1024 * 1024
+
+
+class ZeroCopyTest(unittest.TestCase):
+
+    def map_file(self, data):
+        f = tempfile.TemporaryFile()
+        self.addCleanup(f.close)
+        f.write(data)
+        f.flush()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(m.close)
+        return m
+
+    def peak(self, function, *args):
+        tracemalloc.start()
+        try:
+            result = function(*args)
+            return result, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_hash_format_shares_memory(self):
+        data = bytearray(b'A' * 16)
+        view = encode_decode.hash_format(data)
+        data[0] = ord('B')
+        self.assertEqual(bytes(view[:1]), b'B')
+
+    def test_multi_hash_mmap(self):
+        m = self.map_file(os.urandom(SIZE))
+        digests, peak = self.peak(encode_decode.multi_hash, m)
+        self.assertEqual(digests, encode_decode.multi_hash(bytes(m)))
+        self.assertLess(peak, MAX_PEAK)
+
+    def test_hex_into_mmap(self):
+        data = os.urandom(SIZE)
+        m = self.map_file(data)
+        out = bytearray(2 * SIZE)
+        written, peak = self.peak(encode_decode.string2hex_into, m, out)
+        self.assertEqual(written, 2 * SIZE)
+        self.assertEqual(out[:64], data[:32].hex().encode())
+        self.assertLess(peak, MAX_PEAK)
+
+        encoded = self.map_file(bytes(out))
+        decoded = bytearray(SIZE)
+        written, peak = self.peak(encode_decode.hex2string_into, encoded,
+                                  decoded)
+        self.assertEqual(written, SIZE)
+        self.assertEqual(decoded, data)
+        self.assertLess(peak, MAX_PEAK)
+
+    def test_b64_into_mmap(self):
+        data = os.urandom(SIZE)
+        m = self.map_file(data)
+        out = bytearray(4 * -(-SIZE // 3))
+        written, peak = self.peak(encode_decode.string2b64_into, m, out)
+        self.assertEqual(written, len(out))
+        self.assertLess(peak, MAX_PEAK)
+
+        encoded = self.map_file(bytes(out))
+        decoded = bytearray(SIZE)
+        written, peak = self.peak(encode_decode.b642string_into, encoded,
+                                  decoded)
+        self.assertEqual(written, SIZE)
+        self.assertEqual(decoded, data)
+        self.assertLess(peak, MAX_PEAK)
+
+
+if __name__ == '__main__':
+    unittest.main()
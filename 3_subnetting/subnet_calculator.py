@@ -3,6 +3,33 @@
 IP address and subnet manipulation.
 """
 import ipaddress
+import json
+import mmap
+import re
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_ADDRESS = {4: 2 ** 32 - 1, 6: 2 ** 128 - 1}
+ADDRESS_BITS = {4: 32, 6: 128}
+IPV4_PATTERN = r'(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}' \
+    r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+HOST_LABEL_PATTERN = r'[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?'
+HOSTNAME_PATTERN = r'(?=.{1,254}$)(?P<hostname>(?:%(label)s\.)*' \
+    r'(?=[0-9-]*[A-Za-z])' \
+    r'%(label)s)\.?' % {'label': HOST_LABEL_PATTERN}
+TARGET_RE = re.compile(
+    r'(?P<ipv4>%(ip)s)(?:/(?P<prefix>3[0-2]|[12]?\d)|'
+    r'[ \t]*-[ \t]*(?P<last>%(ip)s))?|%(host)s' %
+    {'ip': IPV4_PATTERN, 'host': HOSTNAME_PATTERN})
+TARGET_CLASSES = ('ipv4', 'ipv6', 'cidr', 'range', 'hostname', 'invalid')
 
 
 def subnet(network, max_hosts=256, min_hosts=128):
@@ -22,14 +49,88 @@ def subnet(network, max_hosts=256, min_hosts=128):
             )
     elif current_hosts == min_hosts:
         return ip_network
-    for pfx_len in range(current_prefix, 32):
-        num_hosts = 2 ** (32 - pfx_len)
+    max_prefix = ip_network.max_prefixlen
+    for pfx_len in range(current_prefix, max_prefix):
+        num_hosts = 2 ** (max_prefix - pfx_len)
         if min_hosts <= num_hosts <= max_hosts:
             new_prefix = pfx_len
             return [str(i) for i in ip_network.subnets(new_prefix=new_prefix)]
     return None
 
 
+def network2interval(network):
+    """
+    Convert a CIDR network to a (version, first, last) integer interval,
+    address ranges and bare addresses raise ValueError.
+    '10.0.0.0/30' -> (4, 167772160, 167772163)
+    """
+    if not isinstance(network, (ipaddress.IPv4Network,
+                                ipaddress.IPv6Network)):
+        if '/' not in str(network):
+            raise ValueError("Expected a CIDR network, received %s" %
+                             network)
+        network = ipaddress.ip_network(str(network).strip(), strict=False)
+    return (network.version, int(network.network_address),
+            int(network.broadcast_address))
+
+
+def iter_subnets(network, new_prefix, as_strings=True):
+    """
+    Lazily yield the child networks of a network with a longer prefix, as
+    CIDR strings or (first, last) integer pairs, for IPv4 and IPv6.
+    '10.0.0.0/23', 24 -> '10.0.0.0/24', '10.0.1.0/24'
+    """
+    version, first, last = network2interval(network)
+    if new_prefix > ADDRESS_BITS[version] or \
+            (1 << (ADDRESS_BITS[version] - new_prefix)) > last - first + 1:
+        raise ValueError("Invalid prefix /%d for %s" % (new_prefix, network))
+    step = 1 << (ADDRESS_BITS[version] - new_prefix)
+    for child in range(first, last + 1, step):
+        if as_strings:
+            yield "%s/%d" % (int2address(version, child), new_prefix)
+        else:
+            yield child, child + step - 1
+
+
+def iter_subnet(network, max_hosts=256, min_hosts=128, as_strings=True):
+    """
+    Lazy version of subnet() for IPv4 and IPv6, yields the child networks
+    of the largest size between min_hosts and max_hosts.
+    '2001:db8::/63', 2 ** 64 -> '2001:db8::/64', '2001:db8:0:1::/64'
+    """
+    version, first, last = network2interval(network)
+    bits = ADDRESS_BITS[version]
+    current_prefix = bits - (last - first + 1).bit_length() + 1
+    for pfx_len in range(current_prefix, bits + 1):
+        if min_hosts <= 2 ** (bits - pfx_len) <= max_hosts:
+            return iter_subnets(network, pfx_len, as_strings)
+    raise ValueError("No subnet of %s between %d and %d hosts" % (
+        network, min_hosts, max_hosts))
+
+
+def vlsm(network, host_counts, as_strings=True):
+    """
+    Variable length subnetting, lazily allocate one aligned child network
+    per host count requirement, largest first, and yield
+    (host_count, network). Raises ValueError when they do not fit.
+    '10.0.0.0/24', [100, 50, 20] -> (100, '10.0.0.0/25'),
+        (50, '10.0.0.128/26'), (20, '10.0.0.192/27')
+    """
+    version, first, last = network2interval(network)
+    bits = ADDRESS_BITS[version]
+    cursor = first
+    for count in sorted(host_counts, reverse=True):
+        size = max(count - 1, 0).bit_length()
+        if cursor + (1 << size) - 1 > last:
+            raise ValueError("Network %s exhausted allocating %d hosts" % (
+                network, count))
+        if as_strings:
+            yield count, "%s/%d" % (int2address(version, cursor), bits - size)
+        else:
+            yield count, (cursor, cursor + (1 << size) - 1)
+        cursor += 1 << size
+
+
 def num_hosts(network):
     """
     Number of hosts included in network.
@@ -62,4 +163,566 @@ def is_ipnetwork(network):
         else:
             return False
     except ValueError:
-        return False
\ No newline at end of file
+        return False
+
+
+def address2int(address):
+    """
+    Convert an IPv4 or IPv6 address into (version, integer).
+    '10.0.0.1' -> (4, 167772161)
+    """
+    if ':' in address:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address),
+                                 'big')
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+
+
+def int2address(version, value):
+    """
+    Convert an integer into an IPv4 or IPv6 address string.
+    4, 167772161 -> '10.0.0.1'
+    """
+    if version == 6:
+        return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+    return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big'))
+
+
+def target2interval(target):
+    """
+    Convert an address, network (host bits are ignored) or range
+    'first-last' into (version, first, last) integers, raises ValueError for
+    anything else.
+    '10.0.0.0/24' -> (4, 167772160, 167772415)
+    """
+    target = target.strip()
+    try:
+        if '/' in target:
+            address, prefix = target.split('/', 1)
+            version, value = address2int(address)
+            bits = ADDRESS_BITS[version]
+            if not prefix.isdigit() or int(prefix) > bits:
+                raise ValueError
+            prefix = int(prefix)
+            host_bits = bits - prefix
+            first = value >> host_bits << host_bits
+            return version, first, first + (1 << host_bits) - 1
+        if '-' in target:
+            first, last = target.split('-', 1)
+            version, first = address2int(first.strip())
+            last_version, last = address2int(last.strip())
+            if version != last_version or last < first:
+                raise ValueError
+            return version, first, last
+        version, value = address2int(target)
+        return version, value, value
+    except (OSError, ValueError):
+        raise ValueError("Invalid target %s" % target)
+
+
+def merge_intervals(intervals):
+    """
+    Sort and merge overlapping or adjacent (first, last) intervals.
+    [(5, 9), (0, 4), (20, 30)] -> [(0, 9), (20, 30)]
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def interval2cidrs(version, first, last):
+    """
+    Split an interval into the minimal list of CIDR blocks.
+    4, 167772160, 167772927 -> ['10.0.0.0/23', '10.0.2.0/24']
+    """
+    bits = ADDRESS_BITS[version]
+    cidrs = []
+    while first <= last:
+        size = (first & -first).bit_length() - 1 if first else bits
+        while first + (1 << size) - 1 > last:
+            size -= 1
+        cidrs.append("%s/%d" % (int2address(version, first), bits - size))
+        first += 1 << size
+    return cidrs
+
+
+class IPSet:
+    """
+    Set of IPv4 and IPv6 addresses stored as sorted, merged integer intervals
+    per version (IPv4 bounds in compact arrays).
+    IPSet(['10.0.0.0/24', '10.0.1.0/24']).cidrs() -> ['10.0.0.0/23']
+    """
+    def __init__(self, targets=(), intervals=None):
+        if intervals is None:
+            intervals = {4: [], 6: []}
+            for target in targets:
+                version, first, last = target2interval(target)
+                intervals[version].append((first, last))
+            intervals = {v: merge_intervals(i) for v, i in intervals.items()}
+        self.firsts = {}
+        self.lasts = {}
+        for version in (4, 6):
+            items = intervals.get(version, [])
+            if version == 4:
+                self.firsts[4] = array('Q', (i[0] for i in items))
+                self.lasts[4] = array('Q', (i[1] for i in items))
+            else:
+                self.firsts[6] = [i[0] for i in items]
+                self.lasts[6] = [i[1] for i in items]
+
+    def intervals(self, version=4):
+        """
+        Merged (first, last) integer intervals for an IP version.
+        """
+        return list(zip(self.firsts[version], self.lasts[version]))
+
+    def _combine(self, other, operation, keep):
+        """
+        Apply an interval operation per version, IPv4 bounds are combined
+        vectorized with numpy when it is installed, keep selects the
+        coverage levels to retain (1 self only, 2 other only, 3 both).
+        """
+        if numpy is None:
+            return IPSet(intervals={v: operation(self.intervals(v),
+                                                 other.intervals(v))
+                                    for v in (4, 6)})
+        result = IPSet(intervals={6: operation(self.intervals(6),
+                                               other.intervals(6))})
+        result.firsts[4], result.lasts[4] = _numpy_combine(
+            self.firsts[4], self.lasts[4], other.firsts[4], other.lasts[4],
+            keep)
+        return result
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: merge_intervals(a + b),
+                             (1, 2, 3))
+
+    def __and__(self, other):
+        return self._combine(other, intersect_intervals, (3,))
+
+    def __sub__(self, other):
+        return self._combine(other, subtract_intervals, (1,))
+
+    def union(self, other):
+        return self | other
+
+    def intersection(self, other):
+        return self & other
+
+    def difference(self, other):
+        return self - other
+
+    def __eq__(self, other):
+        return (isinstance(other, IPSet) and
+                all(self.intervals(v) == other.intervals(v) for v in (4, 6)))
+
+    def __bool__(self):
+        return bool(self.firsts[4]) or bool(self.firsts[6])
+
+    def __len__(self):
+        return len(self.firsts[4]) + len(self.firsts[6])
+
+    def __repr__(self):
+        return "IPSet(%r)" % self.cidrs()
+
+    def __contains__(self, address):
+        version, value = address2int(address) if isinstance(
+            address, str) else (4, address)
+        pos = bisect_right(self.firsts[version], value) - 1
+        return pos >= 0 and value <= self.lasts[version][pos]
+
+    def contains_many(self, addresses):
+        """
+        Membership test for many addresses, IPv4 integer inputs are searched
+        with numpy when it is installed.
+        ['10.0.0.1', '192.168.0.1'] -> [True, False]
+        """
+        if numpy is not None and isinstance(addresses, numpy.ndarray):
+            firsts = numpy.frombuffer(self.firsts[4], dtype=numpy.uint64)
+            lasts = numpy.frombuffer(self.lasts[4], dtype=numpy.uint64)
+            values = addresses.astype(numpy.uint64)
+            pos = numpy.searchsorted(firsts, values, side='right') - 1
+            found = pos >= 0
+            found[found] = values[found] <= lasts[pos[found]]
+            return found
+        return [address in self for address in addresses]
+
+    def num_hosts(self):
+        """
+        Exact number of addresses included in the set.
+        IPSet(['10.0.0.0/24', '10.0.0.128/25']).num_hosts() -> 256
+        """
+        return sum(last - first + 1 for v in (4, 6)
+                   for first, last in self.intervals(v))
+
+    def cidrs(self):
+        """
+        Aggregate the set into the minimal list of CIDR blocks.
+        """
+        return [cidr for v in (4, 6) for first, last in self.intervals(v)
+                for cidr in interval2cidrs(v, first, last)]
+
+
+def _numpy_combine(a_firsts, a_lasts, b_firsts, b_lasts, keep):
+    """
+    Combine two sorted, merged interval arrays with a sweep over their
+    bounds: intervals of a add 1 to the coverage level, intervals of b add
+    2, and the runs whose level is in keep become the merged result.
+    """
+    def bounds(values):
+        return numpy.frombuffer(values, dtype=numpy.uint64) if len(values) \
+            else numpy.zeros(0, dtype=numpy.uint64)
+
+    a_firsts, a_lasts = bounds(a_firsts), bounds(a_lasts)
+    b_firsts, b_lasts = bounds(b_firsts), bounds(b_lasts)
+    positions = numpy.concatenate((a_firsts, a_lasts + 1, b_firsts,
+                                   b_lasts + 1))
+    deltas = numpy.concatenate((
+        numpy.full(len(a_firsts), 1, dtype=numpy.int8),
+        numpy.full(len(a_lasts), -1, dtype=numpy.int8),
+        numpy.full(len(b_firsts), 2, dtype=numpy.int8),
+        numpy.full(len(b_lasts), -2, dtype=numpy.int8)))
+    order = numpy.argsort(positions, kind='stable')
+    positions = positions[order]
+    levels = numpy.cumsum(deltas[order], dtype=numpy.int8)
+    # the level after the last event at each position
+    last_event = numpy.ones(len(positions), dtype=bool)
+    last_event[:-1] = positions[1:] != positions[:-1]
+    positions = positions[last_event]
+    inside = numpy.isin(levels[last_event], keep).astype(numpy.int8)
+    change = numpy.diff(inside, prepend=numpy.int8(0))
+    firsts = array('Q')
+    lasts = array('Q')
+    firsts.frombytes(positions[change == 1].tobytes())
+    lasts.frombytes((positions[change == -1] - 1).tobytes())
+    return firsts, lasts
+
+
+def intersect_intervals(a, b):
+    """
+    Intersection of two sorted, merged interval lists.
+    [(0, 10)], [(5, 20)] -> [(5, 10)]
+    """
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        first = max(a[i][0], b[j][0])
+        last = min(a[i][1], b[j][1])
+        if first <= last:
+            result.append((first, last))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def subtract_intervals(a, b):
+    """
+    Difference of two sorted, merged interval lists.
+    [(0, 10)], [(5, 6)] -> [(0, 4), (7, 10)]
+    """
+    result = []
+    j = 0
+    for first, last in a:
+        while j < len(b) and b[j][1] < first:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] <= last:
+            if b[k][0] > first:
+                result.append((first, b[k][0] - 1))
+            first = max(first, b[k][1] + 1)
+            k += 1
+        if first <= last:
+            result.append((first, last))
+    return result
+
+
+def prefix_segments(prefixes):
+    """
+    Flatten possibly nested (first, last, value) prefixes into sorted,
+    non-overlapping (first, last, value) segments where each address maps to
+    the value of its most specific prefix.
+    [(0, 255, 'a'), (16, 31, 'b')] -> [(0, 15, 'a'), (16, 31, 'b'),
+                                       (32, 255, 'a')]
+    """
+    segments = []
+    stack = []
+    cursor = 0
+    for first, last, value in sorted(prefixes, key=lambda p: (p[0], -p[1])):
+        while stack and stack[-1][0] < first:
+            end, top = stack.pop()
+            if cursor <= end:
+                segments.append((cursor, end, top))
+                cursor = end + 1
+        if stack and cursor < first:
+            segments.append((cursor, first - 1, stack[-1][1]))
+        cursor = first
+        stack.append((last, value))
+    while stack:
+        end, top = stack.pop()
+        if cursor <= end:
+            segments.append((cursor, end, top))
+            cursor = end + 1
+    return segments
+
+
+LPM_MAGIC = b'LPM1'
+LPM_HEADER = struct.Struct('<4sQQQ')
+
+
+def _little_endian(typecode, items):
+    """
+    Convert items to (or from) a 4 byte little endian array of typecode, the
+    on disk layout of LPMIndex whatever the native byte order.
+    """
+    if isinstance(items, bytes):
+        converted = array(typecode)
+        converted.frombytes(items)
+    else:
+        converted = array(typecode, items)
+    if converted.itemsize != 4:
+        raise ValueError("array typecode %s is not 4 bytes on this platform"
+                         % typecode)
+    if sys.byteorder == 'big':
+        converted.byteswap()
+    return converted
+
+
+class LPMIndex:
+    """
+    Longest prefix match index over CIDRs with attached metadata, stored as
+    sorted segment boundaries per IP version. IPv4 lookups on integer arrays
+    are vectorized with numpy.searchsorted when numpy is installed.
+    LPMIndex([('10.0.0.0/8', 'corp'), ('10.1.0.0/16', 'dmz')]).lookup(
+        '10.1.2.3') -> ('10.1.0.0/16', 'dmz')
+    """
+    def __init__(self, entries=(), segments=None):
+        if isinstance(entries, dict):
+            entries = entries.items()
+        self.entries = [(cidr, metadata) for cidr, metadata in entries]
+        if segments is None:
+            prefixes = {4: [], 6: []}
+            for index, (cidr, metadata) in enumerate(self.entries):
+                version, first, last = target2interval(cidr)
+                prefixes[version].append((first, last, index))
+            segments = {v: prefix_segments(p) for v, p in prefixes.items()}
+            self.firsts = {4: array('I', (seg[0] for seg in segments[4])),
+                           6: [seg[0] for seg in segments[6]]}
+            self.lasts = {4: array('I', (seg[1] for seg in segments[4])),
+                          6: [seg[1] for seg in segments[6]]}
+            self.values = {4: array('i', (seg[2] for seg in segments[4])),
+                           6: [seg[2] for seg in segments[6]]}
+        else:
+            self.firsts, self.lasts, self.values = segments
+
+    def lookup_index(self, address):
+        """
+        Index in entries of the most specific prefix including the address,
+        or -1.
+        """
+        version, value = address2int(address) if isinstance(
+            address, str) else (4, address)
+        pos = bisect_right(self.firsts[version], value) - 1
+        if pos >= 0 and value <= self.lasts[version][pos]:
+            return self.values[version][pos]
+        return -1
+
+    def lookup(self, address):
+        """
+        Most specific (cidr, metadata) including the address, or None.
+        """
+        index = self.lookup_index(address)
+        return self.entries[index] if index >= 0 else None
+
+    def lookup_many(self, addresses):
+        """
+        Entry indexes (-1 when not found) for many addresses. A numpy array
+        of IPv4 integers is searched in one numpy.searchsorted call.
+        ['10.1.2.3', '8.8.8.8'] -> [1, -1]
+        """
+        if numpy is not None and isinstance(addresses, numpy.ndarray):
+            firsts = numpy.frombuffer(self.firsts[4], dtype=numpy.uint32)
+            lasts = numpy.frombuffer(self.lasts[4], dtype=numpy.uint32)
+            values = numpy.frombuffer(self.values[4], dtype=numpy.int32)
+            targets = addresses.astype(numpy.uint32, copy=False)
+            pos = numpy.searchsorted(firsts, targets, side='right') - 1
+            valid = pos >= 0
+            pos[~valid] = 0
+            if len(firsts):
+                valid &= targets <= lasts[pos]
+                return numpy.where(valid, values[pos], -1)
+            return numpy.full(len(targets), -1, dtype=numpy.int32)
+        return [self.lookup_index(address) for address in addresses]
+
+    def save(self, path):
+        """
+        Write the index to disk, IPv4 segments as raw little endian arrays
+        that load() memory maps, IPv6 segments and entries as JSON.
+        """
+        trailer = json.dumps({
+            'entries': self.entries,
+            'ipv6': [self.firsts[6], self.lasts[6], self.values[6]],
+        }).encode()
+        firsts, lasts, values = (self.firsts[4], self.lasts[4],
+                                 self.values[4])
+        with open(path, 'wb') as f:
+            f.write(LPM_HEADER.pack(LPM_MAGIC, len(firsts), len(trailer), 0))
+            for typecode, items in (('I', firsts), ('I', lasts),
+                                    ('i', values)):
+                f.write(_little_endian(typecode, items).tobytes())
+            f.write(trailer)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index written by save(). With numpy the IPv4 arrays are
+        views over a shared read-only memory map of the file.
+        """
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, trailer_size, _ = LPM_HEADER.unpack_from(data)
+        if magic != LPM_MAGIC:
+            raise ValueError("Not an LPM index file %s" % path)
+        offset = LPM_HEADER.size
+        arrays = []
+        for typecode in ('I', 'I', 'i'):
+            size = count * 4
+            if numpy is not None:
+                arrays.append(numpy.frombuffer(
+                    data, dtype='<u4' if typecode == 'I' else '<i4',
+                    count=count, offset=offset))
+            else:
+                arrays.append(_little_endian(typecode,
+                                             data[offset:offset + size]))
+            offset += size
+        trailer = json.loads(data[offset:offset + trailer_size])
+        index = cls([tuple(e) for e in trailer['entries']], segments=(
+            {4: arrays[0], 6: trailer['ipv6'][0]},
+            {4: arrays[1], 6: trailer['ipv6'][1]},
+            {4: arrays[2], 6: trailer['ipv6'][2]}))
+        return index
+
+
+def classify_target(target):
+    """
+    Classify and normalize a single target into one of TARGET_CLASSES.
+    IPv4 forms and hostnames are matched by one precompiled regex, only
+    entries with ':' go through inet_pton / ipaddress.
+    '10.0.0.1/24' -> ('cidr', '10.0.0.0/24')
+    """
+    target = target.strip()
+    match = TARGET_RE.fullmatch(target)
+    if match:
+        kind = match.lastgroup
+        if kind == 'ipv4':
+            return kind, target
+        if kind == 'prefix':
+            host_bits = 32 - int(match.group('prefix'))
+            first = address2int(match.group('ipv4'))[1]
+            return 'cidr', "%s/%s" % (
+                int2address(4, first >> host_bits << host_bits),
+                match.group('prefix'))
+        if kind == 'last':
+            return normalize_range(match.group('ipv4'), match.group('last'))
+        return 'hostname', match.group('hostname').lower()
+    if ':' in target:
+        try:
+            if '/' in target:
+                return 'cidr', str(ipaddress.ip_network(target, strict=False))
+            if '-' in target:
+                version, first, last = target2interval(target)
+                return 'range', "%s-%s" % (int2address(6, first),
+                                           int2address(6, last))
+            return 'ipv6', int2address(*address2int(target))
+        except (OSError, ValueError):
+            pass
+    return 'invalid', target
+
+
+def normalize_range(first, last):
+    """
+    Validate an IPv4 range given its (already well formed) bounds.
+    '10.0.0.1', '10.0.0.9' -> ('range', '10.0.0.1-10.0.0.9')
+    """
+    if address2int(first)[1] > address2int(last)[1]:
+        return 'invalid', "%s-%s" % (first, last)
+    return 'range', "%s-%s" % (first, last)
+
+
+def classify_targets(targets):
+    """
+    Bulk classify and normalize targets from an iterable, a file object or
+    a comma/whitespace separated string, returns deduplicated lists per
+    class in input order. Raw entries are deduplicated before matching and
+    plain IPv4 addresses and hostnames never leave the regex fast path.
+    '10.0.0.1,10.0.0.0/24,host.example.com,foo..bar' ->
+        {'ipv4': ['10.0.0.1'], 'cidr': ['10.0.0.0/24'],
+         'hostname': ['host.example.com'], 'invalid': ['foo..bar'], ...}
+    """
+    if isinstance(targets, str):
+        targets = re.split(r'[,\s]+', targets)
+    lines = dict.fromkeys(map(str.strip, targets))
+    lines.pop('', None)
+    columns = {kind: {} for kind in TARGET_CLASSES}
+    ipv4 = columns['ipv4']
+    hostname = columns['hostname']
+    for target, match in zip(lines, map(TARGET_RE.fullmatch, lines)):
+        kind = match and match.lastgroup
+        if kind == 'ipv4':
+            ipv4[target] = None
+        elif kind == 'hostname':
+            hostname[match.group(kind).lower()] = None
+        else:
+            kind, normalized = classify_target(target)
+            columns[kind][normalized] = None
+    return {kind: list(values) for kind, values in columns.items()}
+
+
+def scope2ipset(targets):
+    """
+    Canonicalize a target scope into an IPSet of its addresses, networks and
+    ranges plus the set of hostnames and unparsable entries.
+    '10.0.0.1,10.0.0.0/31,host.example.com' ->
+        (IPSet(['10.0.0.0/31']), {'host.example.com'})
+    """
+    columns = classify_targets(targets)
+    ipset = IPSet(columns['ipv4'] + columns['ipv6'] + columns['cidr'] +
+                  columns['range'])
+    return ipset, set(columns['hostname']) | set(columns['invalid'])
+
+
+def scope_diff(old_targets, new_targets):
+    """
+    Compare two target scopes in merged interval form, reordering or
+    re-expressing the same addresses (e.g. two /25 instead of a /24) is not
+    a change. Added and removed addresses are reported as CIDRs.
+    '10.0.0.0/25,10.0.0.128/25', '10.0.0.0/24,10.0.1.1' ->
+        {'added': ['10.0.1.1/32'], 'removed': [], 'added_names': [],
+         'removed_names': [], 'changed': True}
+    """
+    old_set, old_names = scope2ipset(old_targets)
+    new_set, new_names = scope2ipset(new_targets)
+    added = new_set - old_set
+    removed = old_set - new_set
+    added_names = sorted(new_names - old_names)
+    removed_names = sorted(old_names - new_names)
+    return {
+        'added': added.cidrs(),
+        'removed': removed.cidrs(),
+        'added_names': added_names,
+        'removed_names': removed_names,
+        'changed': bool(added or removed or added_names or removed_names),
+    }
+
+
+def same_scope(old_targets, new_targets):
+    """
+    Check if two target scopes cover exactly the same targets.
+    '10.0.0.1,10.0.0.0', ['10.0.0.0/31'] -> True
+    """
+    return scope2ipset(old_targets) == scope2ipset(new_targets)
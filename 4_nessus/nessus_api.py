@@ -2,13 +2,19 @@
 """
 Nessus API operations with credentials stored in Hashicorp Vault.
 """
+import hashlib
 import hvac
+import os
 import requests
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from os import getcwd
 from datetime import datetime, timezone, timedelta
-from random import randint
+from random import randint, uniform
+from tenable_client import TENABLE_URL, TenableClient
 
 try:
     cwd = getcwd()
@@ -16,13 +22,9 @@ try:
     import subnet_calculator
 except ModuleNotFoundError:
     print("subnet_calculator module not found in path.")
-else:
-    print("Unexpected error:", sys.exc_info()[0])
-    raise
 
 VAULT_URL = environ['VAULT_URL']
 VAULT_TOKEN = environ['VAULT_TOKEN']
-TENABLE_URL = "https://cloud.tenable.com/"
 
 client = hvac.Client(
     url=environ['VAULT_URL'],
@@ -30,6 +32,123 @@ client = hvac.Client(
 )
 auth = client.read('secret/tenable')['data']['data']
 
+EXPORT_CHUNK_SIZE = 1 << 20
+EXPORT_BUFFER_SIZE = 8 << 20
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit, additive increase on success and
+    multiplicative decrease when the server answers 429.
+    limiter = AIMDLimiter(initial=4, maximum=10)
+    """
+    def __init__(self, initial=4, minimum=1, maximum=10, decrease=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class TenableCache:
+    """
+    TTL cache of Tenable.io collections with a name -> object index, kept
+    up to date in place after our own POST/PUT calls.
+    tenable_cache.lookup('target_groups', 'public_10.0.0.0/24')
+    """
+    def __init__(self, loaders, ttl=300):
+        self.loaders = loaders
+        self.ttl = ttl
+        self.entries = dict()
+        self.lock = threading.RLock()
+
+    def load(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                items = self.loaders[key]()
+                entry = (time.monotonic() + self.ttl, items,
+                         {item['name']: item for item in items},
+                         {item.get('id'): i for i, item in enumerate(items)})
+                self.entries[key] = entry
+            return entry
+
+    def collection(self, key):
+        """
+        Cached list of objects in a collection.
+        """
+        return self.load(key)[1]
+
+    def index(self, key):
+        """
+        Cached name -> object index of a collection.
+        """
+        return self.load(key)[2]
+
+    def lookup(self, key, name):
+        """
+        Cached object by name, None when not found.
+        """
+        return self.index(key).get(name)
+
+    def update(self, key, item):
+        """
+        Insert or replace an object in a cached collection, matched by id.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            items, index, positions = entry[1], entry[2], entry[3]
+            position = positions.get(item.get('id'))
+            if position is None:
+                positions[item.get('id')] = len(items)
+                items.append(item)
+            else:
+                index.pop(items[position]['name'], None)
+                items[position] = item
+            index[item['name']] = item
+
+    def invalidate(self, key=None):
+        """
+        Drop one cached collection, or all of them.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+
+tenable = TenableClient(auth=auth)
+tenable_cache = TenableCache({
+    'target_groups': lambda: list_target_groups()['target_groups'],
+    'folders': lambda: list_folders()['folders'],
+    'scans': lambda: list_scans()['scans'] or [],
+    'scanners': lambda: list_scanners()['scanners'],
+    'scan_templates': lambda: list_templates('scan')['templates'],
+    'policy_templates': lambda: list_templates('policy')['templates'],
+})
+
+
 def read_secret(secret_path):
     """
     Read credentials from Hashicorp Vault.
@@ -44,7 +163,7 @@ def list_users():
     url = TENABLE_URL + "users"
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
@@ -55,7 +174,7 @@ def get_users_details(user_id):
     url = TENABLE_URL + "users/" + user_id
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
@@ -66,7 +185,7 @@ def list_target_groups():
     url = TENABLE_URL + "target-groups"
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
@@ -103,20 +222,15 @@ def list_target_groups():
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
-def create_target_groups(target_name, target_members):
+def plan_target_group(target_name, target_members):
     """
-    Create target groups in the Tenable.io platform.
-    response=[create_target_groups("public_"+target,target) for target in
-        split_targets(bb.split('\n'),256)[0]]
+    Compare a target group against the cached listing, returns the action
+    ('create', 'update' or 'noop'), the payload and the existing group.
     """
-    url = TENABLE_URL + "target-groups"
-    headers = {"Accept": "application/json"}
-    # auth = client.read('secret/tenable')['data']['data']
-
     payload = {
         "acls": [
             {
@@ -128,22 +242,95 @@ def create_target_groups(target_name, target_members):
         "name": target_name,
         "members": target_members
     }
-    target_groups = list_target_groups()['target_groups']
-    for target_group in target_groups:
-        if target_group['name'] == payload['name']:
-            if target_group['members'] == payload['members']:
-                return target_group
-            else:
-                payload['acls'] = target_group['acls']
-                payload['type'] = target_group['type']
-                url = url + "/" + str(target_group['id'])
-                response = requests.request("PUT", url,
-                                            headers={**headers, **auth},
-                                            json=payload)
-                return response.json()
-    response = requests.request("POST", url, headers={**headers, **auth},
-                                json=payload)
-    return response.json()
+    target_group = tenable_cache.lookup('target_groups', payload['name'])
+    if not target_group:
+        return 'create', payload, None
+    if subnet_calculator.same_scope(target_group['members'],
+                                    payload['members']):
+        return 'noop', payload, target_group
+    payload['acls'] = target_group['acls']
+    payload['type'] = target_group['type']
+    return 'update', payload, target_group
+
+
+def write_target_group(action, payload, target_group=None, limiter=None):
+    """
+    Create or update a planned target group in the Tenable.io platform.
+    """
+    url = TENABLE_URL + "target-groups"
+    headers = {"Accept": "application/json"}
+    # auth = client.read('secret/tenable')['data']['data']
+
+    if action == 'update':
+        url = url + "/" + str(target_group['id'])
+        response = tenable.request("PUT", url, headers=headers,
+                                   json=payload, limiter=limiter)
+    else:
+        response = tenable.request("POST", url, headers=headers,
+                                   json=payload, limiter=limiter)
+    if response.ok:
+        tenable_cache.update('target_groups', response.json())
+    return response
+
+
+def create_target_groups(target_name, target_members):
+    """
+    Create target groups in the Tenable.io platform.
+    response=[create_target_groups("public_"+target,target) for target in
+        split_targets(bb.split('\n'),256)[0]]
+    """
+    action, payload, target_group = plan_target_group(target_name,
+                                                      target_members)
+    if action == 'noop':
+        return target_group
+    return write_target_group(action, payload, target_group).json()
+
+
+def bulk_target_groups(target_groups, workers=10, limiter=None):
+    """
+    Create or update many target groups concurrently, planned against one
+    cached listing, with the writes throttled by an AIMD limiter.
+    Returns one report per (name, members) pair, in input order.
+    targets = [t if isinstance(t, str) else ",".join(t) for t in
+               split_targets(bb.split('\n'), 256)[0]]
+    report = bulk_target_groups([("public_" + t, t) for t in targets])
+    """
+    if limiter is None:
+        limiter = AIMDLimiter(initial=min(4, workers), maximum=workers)
+    target_groups = list(target_groups)
+    last = {name: i for i, (name, members) in enumerate(target_groups)}
+    report = list()
+    writes = list()
+    for i, (name, members) in enumerate(target_groups):
+        if last[name] != i:
+            report.append({'name': name, 'action': 'duplicate',
+                           'status': None, 'id': None, 'error': None})
+            continue
+        action, payload, target_group = plan_target_group(name, members)
+        item = {'name': name, 'action': action, 'status': None,
+                'id': target_group['id'] if target_group else None,
+                'error': None}
+        report.append(item)
+        if action != 'noop':
+            writes.append((item, payload, target_group))
+
+    def write(planned):
+        item, payload, target_group = planned
+        try:
+            response = write_target_group(item['action'], payload,
+                                          target_group, limiter)
+        except requests.RequestException as e:
+            item['error'] = str(e)
+            return
+        item['status'] = response.status_code
+        if response.ok:
+            item['id'] = response.json().get('id', item['id'])
+        else:
+            item['error'] = response.reason
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write, writes))
+    return report
 
 
 def list_scans():
@@ -154,7 +341,7 @@ def list_scans():
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
@@ -182,7 +369,7 @@ def list_folders():
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
@@ -195,10 +382,10 @@ def create_folder(target):
     # auth = client.read('secret/tenable')['data']['data']
 
     payload = {"name": target}
-    requests.request("POST", url, headers={**headers, **auth},
-                     json=payload)
-    response = [f for f in list_folders()['folders'] if f['name'] == target]
-    return response[0]
+    response = tenable.request("POST", url, headers=headers, json=payload)
+    folder = {"id": response.json()['id'], "name": target}
+    tenable_cache.update('folders', folder)
+    return folder
 
 
 def locate_or_create_folder(folders, target):
@@ -211,7 +398,7 @@ def locate_or_create_folder(folders, target):
         return folder
     else:
         folder = create_folder(target)
-        return folder
+        return [folder]
 
 
 def list_scanners():
@@ -222,22 +409,28 @@ def list_scanners():
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
-def get_template_uuid(template_name='basic', template_type='scan'):
+def list_templates(template_type='scan'):
     """
-    Get Tenable.io template uuid.
+    List scan or policy templates in the Tenable.io platform.
     """
-    url = "https://cloud.tenable.com/editor/" + template_type + "/templates"
+    url = TENABLE_URL + "editor/" + template_type + "/templates"
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
-    template_uuid = [t['uuid'] for t in response.json()['templates']
-                     if t['name'] == template_name][0]
-    return template_uuid
+    response = tenable.request("GET", url, headers=headers)
+    return response.json()
+
+
+def get_template_uuid(template_name='basic', template_type='scan'):
+    """
+    Get Tenable.io template uuid.
+    """
+    return tenable_cache.lookup(template_type + '_templates',
+                                template_name)['uuid']
 
 
 def create_basic_external_scan_per_group(target_scanner='US Cloud Scanner',
@@ -262,21 +455,20 @@ def create_basic_external_scan_per_group(target_scanner='US Cloud Scanner',
     template_uuid = get_template_uuid()
     start_times = dict()
 
-    folder = locate_or_create_folder(list_scans(), 'Internet')[0]['id']
+    folder = (tenable_cache.lookup('folders', 'Internet') or
+              create_folder('Internet'))['id']
     tz = "UTC"
     rrules = "FREQ=" + launch + ";INTERVAL=1"
 
     target_groups = [(g['id'], g['name']) for g in
-                     list_target_groups()['target_groups'] if
+                     tenable_cache.collection('target_groups') if
                      scan_prefix in g['name']]
-    scans = list_scans()['scans']
-    scanner_id = [s['uuid'] for s in list_scanners()['scanners']
-                  if s['name'] == target_scanner][0]
+    scanner_id = tenable_cache.lookup('scanners', target_scanner)['uuid']
 
     for group_id, group_name in target_groups:
         scan_prefix = "Basic " + scan_type + "External - "
         scan_name = scan_prefix + group_name
-        if scan_name in [s['name'] for s in scans]:
+        if tenable_cache.lookup('scans', scan_name):
             print("Skipping already existing scan %s" % (scan_name))
         else:
             start_times[group_name] = randint(1, len(target_groups))
@@ -302,9 +494,11 @@ def create_basic_external_scan_per_group(target_scanner='US Cloud Scanner',
                 },
                 "uuid": template_uuid
             }
-            response = requests.request("POST", url,
-                                        headers={**headers, **auth},
-                                        json=payload)
+            response = tenable.request("POST", url,
+                                       headers=headers,
+                                       json=payload)
+            if response.ok:
+                tenable_cache.update('scans', response.json()['scan'])
             print(response.json())
     print(start_times)
 
@@ -341,8 +535,8 @@ def export_scan(scan_id, export_format="db", password="", password_len=20):
         client.write('secret/tenable/exports/' + scan_id, data={"password": password})
         payload = {**payload, **{"password": password}}
     print(url, payload)
-    response = requests.request("POST", url, headers={**headers, **auth},
-                                json=payload)
+    response = tenable.request("POST", url, headers=headers,
+                               json=payload)
     return response.json()
 
 
@@ -354,26 +548,117 @@ def check_export_status(scan_id, file_id):
     headers = {"Accept": "application/json"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
+    response = tenable.request("GET", url, headers=headers)
     return response.json()
 
 
-def download_exported_scan(scan_id, file_id):
+def download_exported_scan(scan_id, file_id, path=None, checksum=None,
+                           retries=3):
     """
-    Download exported from the Tenable.io platform.
+    Download exported scan from the Tenable.io platform, streamed to disk in
+    constant memory. A partial download (path + '.part') is resumed with a
+    Range request, the sha256 is checked against checksum when given.
+    path, sha256 = download_exported_scan('12', '345', 'scan.nessus')
     """
     url = TENABLE_URL + "scans/" + scan_id + "/export/" + file_id + "/download"
-    headers = {"Accept": "application/json"}
+    # identity encoding so Content-Length and Range count the bytes on disk
+    headers = {"Accept": "application/octet-stream",
+               "Accept-Encoding": "identity"}
     # auth = client.read('secret/tenable')['data']['data']
 
-    response = requests.request("GET", url, headers={**headers, **auth})
-
-    with open(scan_id + file_id, 'wb') as f:
-        f.write(response.text)
-    return
-
-for t in tgs:
-    create_target_groups(t[0]+'_'+t[1],t[1])
+    path = path or scan_id + file_id
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        digest = hashlib.sha256()
+        size = 0
+        if os.path.exists(part):
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(EXPORT_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+        range_headers = {"Range": "bytes=%d-" % size} if size else {}
+        response = tenable.request("GET", url, stream=True,
+                                   headers={**headers, **range_headers})
+        if response.status_code == 416:
+            response.close()
+            break
+        response.raise_for_status()
+        if response.status_code != 206:
+            digest = hashlib.sha256()
+            size = 0
+        expected = response.headers.get('Content-Length')
+        expected = size + int(expected) if expected else None
+        try:
+            with open(part, 'ab' if size else 'wb',
+                      buffering=EXPORT_BUFFER_SIZE) as f:
+                for chunk in response.iter_content(EXPORT_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            continue
+        finally:
+            response.close()
+        if expected is None or size == expected:
+            break
+        if attempt == retries:
+            raise IOError("Incomplete download %s: %d of %d bytes" %
+                          (path, size, expected))
+    if checksum and digest.hexdigest() != checksum.lower():
+        os.remove(part)
+        raise ValueError("Checksum mismatch for %s" % (path))
+    os.replace(part, path)
+    return path, digest.hexdigest()
+
+
+def wait_for_export(scan_id, file_id, interval=1, max_interval=30,
+                    timeout=3600):
+    """
+    Poll an export status with exponential backoff until it is ready.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        status = check_export_status(scan_id, file_id).get('status')
+        if status == 'ready':
+            return status
+        if status == 'error':
+            raise RuntimeError("Export %s of scan %s failed" %
+                               (file_id, scan_id))
+        if time.monotonic() + interval > deadline:
+            raise TimeoutError("Export %s of scan %s not ready after %ds" %
+                               (file_id, scan_id, timeout))
+        time.sleep(uniform(interval / 2, interval))
+        interval = min(max_interval, interval * 2)
+
+
+def export_scans(scan_ids, export_format="nessus", directory=".", workers=4,
+                 **kwargs):
+    """
+    Export, wait for and download many scans in parallel, one report per
+    scan with the downloaded path, sha256 or error.
+    report = export_scans([s['id'] for s in list_scans()['scans']])
+    """
+    def export(scan_id):
+        scan_id = str(scan_id)
+        item = {'scan_id': scan_id, 'file_id': None, 'path': None,
+                'sha256': None, 'error': None}
+        try:
+            file_id = str(export_scan(scan_id, export_format)['file'])
+            item['file_id'] = file_id
+            wait_for_export(scan_id, file_id, **kwargs)
+            path = os.path.join(directory, scan_id + "_" + file_id + "." +
+                                export_format)
+            item['path'], item['sha256'] = download_exported_scan(
+                scan_id, file_id, path)
+        except (requests.RequestException, KeyError, RuntimeError,
+                TimeoutError, IOError, ValueError) as e:
+            item['error'] = str(e)
+        return item
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(export, scan_ids))
 
 
 def create_internal_scan_per_group(target_scanner, enable=False,
@@ -398,21 +683,20 @@ def create_internal_scan_per_group(target_scanner, enable=False,
     template_uuid = get_template_uuid()
     start_times = dict()
 
-    folder = locate_or_create_folder(list_scans(), 'Intranet')[0]['id']
+    folder = (tenable_cache.lookup('folders', 'Intranet') or
+              create_folder('Intranet'))['id']
     tz = "UTC"
     rrules = "FREQ=" + launch + ";INTERVAL=1"
 
     target_groups = [(g['id'], g['name']) for g in
-                     list_target_groups()['target_groups'] if
+                     tenable_cache.collection('target_groups') if
                      'Default' not in g['name'] and 'public' not in g['name'].lower()]
-    scans = list_scans()['scans']
-    scanner_id = [s['uuid'] for s in list_scanners()['scanners']
-                  if s['name'] == target_scanner][0]
+    scanner_id = tenable_cache.lookup('scanners', target_scanner)['uuid']
 
     for group_id, group_name in target_groups:
         scan_prefix = "Basic " + scan_type + " - "
         scan_name = scan_prefix + group_name
-        if scan_name in [s['name'] for s in scans]:
+        if tenable_cache.lookup('scans', scan_name):
             print("Skipping already existing scan %s" % (scan_name))
         else:
             start_times[group_name] = randint(1, len(target_groups))
@@ -438,8 +722,10 @@ def create_internal_scan_per_group(target_scanner, enable=False,
                 },
                 "uuid": template_uuid
             }
-            response = requests.request("POST", url,
-                                        headers={**headers, **auth},
-                                        json=payload)
+            response = tenable.request("POST", url,
+                                       headers=headers,
+                                       json=payload)
+            if response.ok:
+                tenable_cache.update('scans', response.json()['scan'])
             print(response.json())
     print(start_times)
\ No newline at end of file
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Streaming parser for Tenable .nessus (v2) exports.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from itertools import islice
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ReportHost = namedtuple('ReportHost', ['report', 'name', 'properties'])
+ReportItem = namedtuple('ReportItem', [
+    'host', 'port', 'protocol', 'svc_name', 'severity', 'plugin_id',
+    'plugin_name', 'plugin_family', 'risk_factor', 'cvss_base_score',
+    'cvss3_base_score', 'cve', 'synopsis', 'solution', 'description',
+    'plugin_output'])
+# child elements of ReportItem copied as is, the rest are ignored
+ITEM_TEXT = ('risk_factor', 'cvss_base_score', 'cvss3_base_score',
+             'synopsis', 'solution', 'description', 'plugin_output')
+# values repeated across every host, interned to share one string
+INTERNED = ('plugin_name', 'plugin_family', 'svc_name', 'protocol',
+            'risk_factor', 'cvss_base_score', 'cvss3_base_score', 'synopsis',
+            'solution', 'description')
+PARQUET_BATCH_SIZE = 65536
+
+
+def parse_nessus(source, hosts=True, items=True):
+    """
+    Yield ReportHost and ReportItem records from a .nessus file or file
+    object, clearing every parsed element so memory stays bounded by one
+    ReportHost.
+    [i.plugin_name for i in parse_nessus('scan.nessus', hosts=False)]
+    """
+    intern = sys.intern
+    context = ET.iterparse(source, events=('start', 'end'))
+    report = report_name = host_name = None
+    for event, elem in context:
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'ReportHost':
+                host_name = intern(elem.get('name', ''))
+            elif tag == 'Report':
+                report = elem
+                report_name = elem.get('name', '')
+            continue
+        if tag == 'ReportItem':
+            if items:
+                fields = dict.fromkeys(ITEM_TEXT)
+                cve = list()
+                for child in elem:
+                    if child.tag in fields:
+                        fields[child.tag] = child.text
+                    elif child.tag == 'cve':
+                        cve.append(child.text)
+                fields['plugin_name'] = elem.get('pluginName')
+                fields['plugin_family'] = elem.get('pluginFamily')
+                fields['svc_name'] = elem.get('svc_name')
+                fields['protocol'] = elem.get('protocol')
+                for name in INTERNED:
+                    if fields[name] is not None:
+                        fields[name] = intern(fields[name])
+                yield ReportItem(
+                    host=host_name,
+                    port=int(elem.get('port', 0)),
+                    protocol=fields['protocol'],
+                    svc_name=fields['svc_name'],
+                    severity=int(elem.get('severity', 0)),
+                    plugin_id=int(elem.get('pluginID', 0)),
+                    plugin_name=fields['plugin_name'],
+                    plugin_family=fields['plugin_family'],
+                    risk_factor=fields['risk_factor'],
+                    cvss_base_score=fields['cvss_base_score'],
+                    cvss3_base_score=fields['cvss3_base_score'],
+                    cve=cve,
+                    synopsis=fields['synopsis'],
+                    solution=fields['solution'],
+                    description=fields['description'],
+                    plugin_output=fields['plugin_output'])
+            elem.clear()
+        elif tag == 'HostProperties':
+            if hosts:
+                yield ReportHost(report_name, host_name,
+                                 {t.get('name'): t.text for t in elem})
+            elem.clear()
+        elif tag == 'ReportHost':
+            elem.clear()
+            if report is not None:
+                report.clear()
+        elif tag == 'Policy':
+            elem.clear()
+
+
+def report_items(source):
+    """
+    Yield only the ReportItem records of a .nessus file.
+    """
+    return parse_nessus(source, hosts=False)
+
+
+def _row(item):
+    row = item._asdict()
+    row['cve'] = ','.join(item.cve)
+    return row
+
+
+def items2csv(records, output):
+    """
+    Write ReportItem records to a CSV file, CVEs comma joined.
+    items2csv(report_items('scan.nessus'), 'scan.csv') -> rows written
+    """
+    count = 0
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=ReportItem._fields)
+        writer.writeheader()
+        for item in records:
+            writer.writerow(_row(item))
+            count += 1
+    return count
+
+
+def items2jsonl(records, output):
+    """
+    Write ReportItem records to a JSON lines file.
+    items2jsonl(report_items('scan.nessus'), 'scan.jsonl') -> rows written
+    """
+    count = 0
+    with open(output, 'w', encoding='utf-8') as f:
+        for item in records:
+            f.write(json.dumps(item._asdict()) + '\n')
+            count += 1
+    return count
+
+
+def items2parquet(records, output, batch_size=PARQUET_BATCH_SIZE):
+    """
+    Write ReportItem records to a Parquet file in row groups of batch_size,
+    requires pyarrow.
+    items2parquet(report_items('scan.nessus'), 'scan.parquet') -> rows written
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for Parquet output")
+    schema = pyarrow.schema(
+        [(name, pyarrow.int64()) if name in ('port', 'severity', 'plugin_id')
+         else (name, pyarrow.list_(pyarrow.string())) if name == 'cve'
+         else (name, pyarrow.string()) for name in ReportItem._fields])
+    count = 0
+    records = iter(records)
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            columns = [list(column) for column in zip(*batch)]
+            writer.write_table(pyarrow.table(columns, schema=schema))
+            count += len(batch)
+    return count
+
+
+SINKS = {
+    'csv': items2csv,
+    'jsonl': items2jsonl,
+    'parquet': items2parquet,
+}
+
+
+def convert(source, output, output_format=None):
+    """
+    Convert the ReportItems of a .nessus file to CSV, JSONL or Parquet,
+    the format defaults to the output file extension.
+    convert('scan.nessus', 'scan.parquet') -> rows written
+    """
+    output_format = output_format or os.path.splitext(output)[1][1:]
+    if output_format not in SINKS:
+        raise ValueError("Unsupported output format: %s" % (output_format))
+    return SINKS[output_format](report_items(source), output)
+
+
+def synthetic_nessus(path, hosts=1000, items_per_host=50, plugins=500,
+                     seed=0):
+    """
+    Write a synthetic .nessus export for benchmarks, returns its size.
+    """
+    rng = random.Random(seed)
+    families = ['General', 'Web Servers', 'Windows', 'Misc.', 'Databases']
+    risks = ['None', 'Low', 'Medium', 'High', 'Critical']
+    catalog = [(1000 + p, 'Synthetic plugin %d' % p, rng.choice(families),
+                rng.randrange(5)) for p in range(plugins)]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" ?>\n<NessusClientData_v2>\n'
+                '<Policy><policyName>synthetic</policyName></Policy>\n'
+                '<Report name="synthetic">\n')
+        for h in range(hosts):
+            ip = '10.%d.%d.%d' % (h >> 16 & 255, h >> 8 & 255, h & 255)
+            f.write('<ReportHost name="%s"><HostProperties>'
+                    '<tag name="host-ip">%s</tag>'
+                    '<tag name="operating-system">Linux Kernel</tag>'
+                    '</HostProperties>\n' % (ip, ip))
+            for plugin_id, name, family, severity in rng.sample(
+                    catalog, min(items_per_host, plugins)):
+                port = rng.choice((0, 22, 80, 443, 3306))
+                f.write(
+                    '<ReportItem port="%d" svc_name="%s" protocol="tcp" '
+                    'severity="%d" pluginID="%d" pluginName=%s '
+                    'pluginFamily=%s>'
+                    '<plugin_name>%s</plugin_name>'
+                    '<plugin_family>%s</plugin_family>'
+                    '<risk_factor>%s</risk_factor>'
+                    '<synopsis>%s synopsis.</synopsis>'
+                    '<description>%s description, repeated text to give the '
+                    'item a realistic size for a benchmark.</description>'
+                    '<solution>Upgrade.</solution>'
+                    '<cve>CVE-2020-%04d</cve>'
+                    '<plugin_output>%s</plugin_output></ReportItem>\n' % (
+                        port, 'www' if port in (80, 443) else 'general',
+                        severity, plugin_id, quoteattr(name),
+                        quoteattr(family), escape(name), escape(family),
+                        risks[severity], escape(name), escape(name),
+                        plugin_id % 10000,
+                        'Port %d/tcp was found open on %s' % (port, ip)))
+            f.write('</ReportHost>\n')
+        f.write('</Report>\n</NessusClientData_v2>\n')
+    return os.path.getsize(path)
+
+
+def parser_benchmark(path=None, hosts=2000, items_per_host=50):
+    """
+    Parse a .nessus file, a synthetic one when no path is given, and report
+    throughput and peak memory.
+    """
+    synthetic = path is None
+    if synthetic:
+        fd, path = tempfile.mkstemp(suffix='.nessus')
+        os.close(fd)
+    try:
+        if synthetic:
+            synthetic_nessus(path, hosts, items_per_host)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        records = sum(1 for _ in parse_nessus(path))
+        elapsed = time.perf_counter() - start
+    finally:
+        if synthetic:
+            os.remove(path)
+    result = {'bytes': size, 'records': records, 'seconds': elapsed,
+              'mb_per_second': size / elapsed / 1e6}
+    if resource:
+        result['max_rss_mb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def main(argv=None):
+    """
+    Convert the ReportItems of a .nessus export to CSV, JSONL or Parquet.
+    nessus_parser.py scan.nessus scan.parquet
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('source', help=".nessus file")
+    parser.add_argument('output', help="output file")
+    parser.add_argument('-f', '--format', choices=sorted(SINKS),
+                        help="output format, defaults to the extension")
+    args = parser.parse_args(argv)
+    try:
+        count = convert(args.source, args.output, args.format)
+    except (ValueError, ImportError) as error:
+        parser.error(str(error))
+    print("%d items written to %s" % (count, args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Pooled, retrying HTTP client for the Tenable.io API.
+"""
+import re
+import requests
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from random import uniform
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+TENABLE_URL = "https://cloud.tenable.com/"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+ENDPOINT_ID_RE = re.compile(r'/(?:\d+|[0-9a-f]{8}-[0-9a-f-]{27,}|'
+                            r'[0-9a-f]{32,})(?=/|$)')
+
+
+def not_sent(error):
+    """
+    True when a requests exception was raised before the request reached
+    the server, a connect timeout or a refused connection.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class TenableClient:
+    """
+    Shared Tenable.io HTTP client, a connection pooled requests.Session with
+    keep-alive, retries with exponential backoff and jitter on 429/5xx
+    (honoring Retry-After) and per endpoint latency metrics.
+    """
+    def __init__(self, base_url=TENABLE_URL, auth=None, pool_size=10,
+                 retries=5, backoff=0.5, max_backoff=60, timeout=60):
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({"Accept": "application/json"})
+        self.session.headers.update(auth or {})
+        self.metrics = defaultdict(lambda: {'count': 0, 'errors': 0,
+                                            'retries': 0, 'total': 0.0,
+                                            'max': 0.0})
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Seconds to wait before a retry, Retry-After when the server sent
+        one, otherwise full jitter exponential backoff.
+        """
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after) -
+                             datetime.now(timezone.utc)).total_seconds()
+                    return min(max(delay, 0), self.max_backoff)
+                except (TypeError, ValueError):
+                    pass
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def endpoint(self, method, url):
+        if url.startswith(self.base_url):
+            url = url[len(self.base_url):]
+        return method + " " + ENDPOINT_ID_RE.sub('/{id}', '/' + url)
+
+    def request(self, method, url, retry=None, **kwargs):
+        """
+        Send a request to a Tenable.io path or full URL, retrying on
+        connection errors, 429 and 5xx responses.
+        tenable.request("GET", "scans").json()
+        Only idempotent methods are retried by default, other methods (POST)
+        only on 429 or when the connection failed before the request was
+        sent, unless the caller opts in with retry=True.
+        An optional limiter (AIMDLimiter) bounds the requests in flight and
+        is told about 429 responses.
+        """
+        if not url.startswith('http'):
+            url = self.base_url + url
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+        metric = self.metrics[self.endpoint(method, url)]
+        limiter = kwargs.pop('limiter', None)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if limiter:
+                limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if limiter:
+                    limiter.release()
+                metric['errors'] += 1
+                if attempt == self.retries or not (retry or not_sent(e)):
+                    raise
+                metric['retries'] += 1
+                time.sleep(self.retry_delay(attempt))
+                continue
+            elapsed = time.perf_counter() - start
+            if limiter:
+                limiter.release(response.status_code == 429)
+            metric['count'] += 1
+            metric['total'] += elapsed
+            metric['max'] = max(metric['max'], elapsed)
+            if attempt < self.retries and (
+                    response.status_code == 429 or
+                    retry and response.status_code in RETRY_STATUSES):
+                metric['retries'] += 1
+                response.close()
+                time.sleep(self.retry_delay(attempt, response))
+                continue
+            if response.status_code >= 400:
+                metric['errors'] += 1
+            return response
+
+    def latency_report(self):
+        """
+        Per endpoint request count, errors, retries, mean and max latency.
+        """
+        return {endpoint: dict(m, mean=m['total'] / m['count']
+                               if m['count'] else 0.0)
+                for endpoint, m in self.metrics.items()}
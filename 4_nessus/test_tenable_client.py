@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for the Tenable.io client against a local stub HTTP server.
+"""
+import json
+import socket
+import threading
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+from tenable_client import TenableClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers each request with the next queued status for its path, then 200.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_any(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.calls.append((self.command, self.path))
+            queued = server.statuses.get(self.path)
+            status = queued.pop(0) if queued else 200
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = handle_any
+
+
+class TenableClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.calls = list()
+        self.server.statuses = dict()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.client = TenableClient(base_url=self.base_url,
+                                    auth={'X-ApiKeys': 'stub'},
+                                    retries=3, backoff=0.01)
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_retried_on_5xx(self):
+        self.server.statuses['/scans'] = [502, 503]
+        response = self.client.request("GET", "scans")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.calls), 3)
+        self.assertEqual(self.client.latency_report()['GET /scans']['retries'],
+                         2)
+
+    def test_post_not_retried_on_5xx(self):
+        self.server.statuses['/target-groups'] = [502]
+        response = self.client.request("POST", "target-groups", json={})
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.server.calls, [("POST", "/target-groups")])
+
+    def test_post_retried_on_429(self):
+        self.server.statuses['/target-groups'] = [429]
+        response = self.client.request("POST", "target-groups", json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_post_retry_opt_in(self):
+        self.server.statuses['/scans'] = [502]
+        response = self.client.request("POST", "scans", json={}, retry=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_post_retried_when_not_sent(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            closed_url = 'http://127.0.0.1:%d/' % s.getsockname()[1]
+        client = TenableClient(base_url=closed_url, retries=2, backoff=0.01)
+        with self.assertRaises(Exception):
+            client.request("POST", "scans", json={})
+        self.assertEqual(client.latency_report()['POST /scans']['retries'], 2)
+
+    def test_retry_after_date(self):
+        class Response:
+            headers = {'Retry-After': formatdate(time() + 30, usegmt=True)}
+        self.assertTrue(25 < self.client.retry_delay(0, Response()) <= 30)
+
+    def test_endpoint_ids_collapsed(self):
+        self.assertEqual(self.client.endpoint("GET", self.base_url +
+                                              "scans/42/export/7/status"),
+                         "GET /scans/{id}/export/{id}/status")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,26 +2,57 @@
 """
 Scan the network or hosts.
 """
+import asyncio
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import random
 import socket
+import sys
 import requests
 import re
-from os.path import exists
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from math import gcd
+from collections import namedtuple
+from os.path import abspath, dirname, exists, join
 from requests.models import ProtocolError
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '3_subnetting'))
+import subnet_calculator
+
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
-if exists("nmap-services"):
-    servicesfile = open("nmap-services", 'r').read()
-else:
+SERVICES_FILE = "nmap-services"
+SERVICES_INDEX = SERVICES_FILE + ".idx"
+SERVICES_INDEX_VERSION = 2
+if not exists(SERVICES_FILE):
     servicesfile_url="https://raw.githubusercontent.com/nmap/nmap/master/nmap-services"
     servicesfile = requests.get(servicesfile_url).text
-    with open("nmap-services", 'w') as f:
+    with open(SERVICES_FILE, 'w') as f:
         f.write(servicesfile)
 servicere = re.compile(r"(.+)\t(\d+)\/(tcp|udp)\t\b(0\.\d+)")
+range_rx = re.compile(r'^\s*(\d+)-(\d+)\s*$|^(.*)$')
+services_index = None
+
+ScanResult = namedtuple('ScanResult', ['host', 'port', 'protocol', 'open'])
+Fingerprint = namedtuple('Fingerprint', ['host', 'port', 'protocol',
+                                         'service', 'product', 'banner'])
 
 class service:
+    __slots__ = ('name', 'port', 'protocol', 'frequency')
     def __init__(self, name, port, protocol, frequency):
         self.name = name
         self.port = int(port)
@@ -34,24 +65,121 @@ class service:
     def __ne__(self, other):
         return not (self == other)
 
+def build_services_index(path=SERVICES_FILE):
+    """
+    Parse nmap-services once into compact columns: names, ports, protocols
+    and frequencies arrays, a name -> entries dict and, per protocol, the
+    entries pre-sorted by descending frequency.
+    """
+    with open(path, 'r') as f:
+        entries = servicere.findall(f.read())
+    names = [sys.intern(e[0]) for e in entries]
+    ports = array('H', (int(e[1]) for e in entries))
+    protocols = [sys.intern(e[2]) for e in entries]
+    frequencies = array('d', (float(e[3]) for e in entries))
+    by_name = {}
+    for pos, name in enumerate(names):
+        by_name.setdefault(name, []).append(pos)
+    order = sorted(range(len(entries)), key=lambda i: -frequencies[i])
+    ranked = {None: array('L', order)}
+    for protocol in set(protocols):
+        ranked[protocol] = array('L', (i for i in order
+                                       if protocols[i] == protocol))
+    cumulative = {protocol: array('d', accumulate(frequencies[i]
+                                                  for i in positions))
+                  for protocol, positions in ranked.items()}
+    return {'version': SERVICES_INDEX_VERSION,
+            'mtime_ns': os.stat(path).st_mtime_ns, 'source': abspath(path),
+            'names': names, 'ports': ports, 'protocols': protocols,
+            'frequencies': frequencies, 'by_name': by_name,
+            'ranked': ranked, 'cumulative': cumulative}
+
+
+def load_services_index(path=SERVICES_FILE, cache=SERVICES_INDEX):
+    """
+    Return the services index, kept in memory once loaded and cached on disk
+    as a pickle that is rebuilt only when the source mtime changes.
+    """
+    global services_index
+    mtime_ns = os.stat(path).st_mtime_ns
+    if services_index and services_index['source'] == abspath(path) and \
+            services_index['mtime_ns'] == mtime_ns:
+        return services_index
+    try:
+        with open(cache, 'rb') as f:
+            index = pickle.load(f)
+        if index.get('version') != SERVICES_INDEX_VERSION or \
+                index['source'] != abspath(path) or \
+                index['mtime_ns'] != mtime_ns:
+            raise ValueError("Stale services index")
+    except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        index = build_services_index(path)
+        try:
+            with open(cache, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            logger.debug("Unable to write services index %s" % cache)
+    services_index = index
+    return index
+
+
+def index_service(index, pos):
+    return service(index['names'][pos], index['ports'][pos],
+                   index['protocols'][pos], index['frequencies'][pos])
+
+
+def all_services(protocol=None):
+    """
+    All known services as service objects, most frequent first.
+    """
+    index = load_services_index()
+    return [index_service(index, pos) for pos in index['ranked'][protocol]]
+
+
+def service_ports(name):
+    """
+    Ports registered for a service name.
+    'ssh' -> [22]
+    """
+    index = load_services_index()
+    return [index['ports'][pos] for pos in index['by_name'].get(name, ())]
+
+
 def servicefrequency(item):
     return item.frequency
 
 def top(servicelist, protocol=None, limit=100):
-    if len(servicelist)>limit:
-        final_item = limit
-    else:
-        final_item = len(servicelist)
-    logger.debug("Limit set to %d" % (final_item))
-    if not protocol:
-        return sorted(servicelist, key=servicefrequency, reverse=True)[:final_item]
-    else:
-        return [s for s in sorted(servicelist, key=servicefrequency, reverse=True) if s.protocol==protocol][:final_item]
+    if protocol:
+        servicelist = [s for s in servicelist if s.protocol == protocol]
+    logger.debug("Limit set to %d" % (min(limit, len(servicelist))))
+    return heapq.nlargest(limit, servicelist, key=servicefrequency)
+
+def top_services(protocol=None, limit=100):
+    """
+    Most frequent known services from the precomputed ranking, same result
+    as top(all_services(), protocol, limit) without sorting.
+    'tcp', 3 -> [http 80/tcp, telnet 23/tcp, https 443/tcp]
+    """
+    index = load_services_index()
+    return [index_service(index, pos)
+            for pos in index['ranked'].get(protocol, ())[:limit]]
+
+def coverage_services(coverage=0.95, protocol='tcp'):
+    """
+    Smallest set of services whose open frequency adds up to the given
+    share of the total frequency for the protocol, most frequent first.
+    0.5, 'tcp' -> [http 80/tcp, telnet 23/tcp, ...]
+    """
+    index = load_services_index()
+    cumulative = index['cumulative'].get(protocol)
+    if not cumulative:
+        return []
+    count = bisect_left(cumulative, cumulative[-1] * coverage) + 1
+    return [index_service(index, pos)
+            for pos in index['ranked'][protocol][:count]]
 
 def get_port_range(port_range):
-    range_rx = re.compile(r'^\s*(\d+)-(\d+)\s*$|^(.*)$')
     ports = []
-    service_list = None
     for range_item in port_range.split(','):
         range_string = range_rx.match(range_item).groups()
         if range_string[0] and range_string[1]:
@@ -66,40 +194,504 @@ def get_port_range(port_range):
             try:
                 ports.append(int(range_string[2]))
             except ValueError:
-                if not service_list:
-                    with open("nmap-services", 'r') as f:
-                        service_list = servicere.findall(f.read())
-                [ports.append(service(*sname).port) for sname in service_list if sname[0] == range_string[2]]
+                ports += service_ports(range_string[2])
             except:
                 logger.error("Invalid port_range value received")
                 pass
-    logger.debug("Identified ports: %s" % ','.join([str(p) for p in ports]))
-    unique_ports  = {}
-    for port in ports:
-        unique_ports[port] = 1
-    unique_ports.keys()
-    return unique_ports.keys()
-
-def portscan(host, services_to_scan=None, port_range=None, timeout=0.5):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Identified ports: %s" % ','.join([str(p) for p in ports]))
+    return dict.fromkeys(ports).keys()
+
+def portscan(host, services_to_scan=None, port_range=None, timeout=0.5,
+             log_closed=False):
     try:
         socket.setdefaulttimeout(float(timeout))
     except:
         socket.setdefaulttimeout(1)
     port_list = None
     if not services_to_scan and not port_range:
-        services_to_scan = top([service(*s) for s in servicere.findall(servicesfile)], protocol="tcp")
+        services_to_scan = top_services(protocol="tcp")
     if services_to_scan and port_range:
         logger.error("Use only either services_to_scan or port_range.")
         return
     if port_range and not services_to_scan:
         port_list = get_port_range(port_range)
         services_to_scan = [service('', port, 'tcp', 0.0) for port in port_list]
+    results = []
     for item in services_to_scan:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if sock.connect_ex((host,int(item.port))) == 0:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            is_open = sock.connect_ex((host, int(item.port))) == 0
+        results.append(ScanResult(host, int(item.port), item.protocol, is_open))
+        if is_open:
             logger.info("Host %s - Port %s/%d is open" % (host, item.protocol, item.port))
-        else:
+        elif log_closed:
             logger.info("Host %s - Port %s/%d is closed" % (host, item.protocol, item.port))
+    return results
+
+
+
+def select_ports(services_to_scan=None, port_range=None):
+    """
+    Resolve the ports to scan the same way portscan does, top 100 tcp
+    services by default.
+    port_range='22,80-81' -> [22, 80, 81]
+    """
+    if services_to_scan and port_range:
+        logger.error("Use only either services_to_scan or port_range.")
+        return []
+    if port_range:
+        return list(get_port_range(port_range) or [])
+    if not services_to_scan:
+        services_to_scan = top_services(protocol="tcp")
+    return [item.port for item in services_to_scan]
+
+
+def iter_hosts(targets):
+    """
+    Expand addresses, CIDRs and ranges lazily into host addresses, other
+    targets (hostnames) are yielded as they are.
+    ['10.0.0.0/31', 'example.com'] -> '10.0.0.0', '10.0.0.1', 'example.com'
+    """
+    if isinstance(targets, str):
+        targets = targets.split(',')
+    for target in targets:
+        try:
+            version, first, last = subnet_calculator.target2interval(target)
+        except ValueError:
+            yield target.strip()
+            continue
+        for value in range(first, last + 1):
+            yield subnet_calculator.int2address(version, value)
+
+
+def fd_budget(concurrency, reserve=64):
+    """
+    Cap the number of simultaneous sockets to the open files soft limit.
+    """
+    if resource is None:
+        return concurrency
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, soft - reserve))
+
+
+async def probe(host, port, timeout=0.5):
+    """
+    Try a non-blocking TCP connect, returns True when the port is open.
+    Hosts that fail to resolve, including malformed names, count as closed.
+    """
+    loop = asyncio.get_running_loop()
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, (host, port)), timeout)
+        return True
+    except (asyncio.TimeoutError, OSError, ValueError):
+        return False
+    finally:
+        sock.close()
+
+
+async def scan_stream(targets, services_to_scan=None, port_range=None,
+                      timeout=0.5, concurrency=1000, per_host=100):
+    """
+    Asynchronous TCP connect scan of many hosts, yields ScanResult records
+    as they complete. concurrency bounds the open sockets overall (and by
+    the open files limit), per_host bounds them for a single host. Work is
+    ordered port by port across hosts so no host gets all probes at once,
+    hosts are addressed by position so CIDRs are never expanded in memory.
+    async for r in scan_stream(['127.0.0.1'], port_range='1-1024'): ...
+    """
+    ports = select_ports(services_to_scan, port_range)
+    blocks = host_intervals(targets)
+    offsets = [0] + list(accumulate(count for _, _, count in blocks))
+    host_count = offsets[-1]
+    work = ((host_at(blocks, offsets, position), port) for port in ports
+            for position in range(host_count))
+    # [semaphore, probes waiting or running], dropped when no longer used
+    host_limits = {}
+    results = asyncio.Queue(maxsize=concurrency * 2)
+    done = object()
+
+    async def worker():
+        try:
+            for host, port in work:
+                limit = host_limits.get(host)
+                if limit is None:
+                    limit = host_limits[host] = [asyncio.Semaphore(per_host),
+                                                 0]
+                limit[1] += 1
+                try:
+                    async with limit[0]:
+                        is_open = await probe(host, port, timeout)
+                finally:
+                    limit[1] -= 1
+                    if not limit[1]:
+                        del host_limits[host]
+                await results.put(ScanResult(host, port, 'tcp', is_open))
+        finally:
+            await results.put(done)
+
+    workers = [asyncio.ensure_future(worker()) for _ in
+               range(min(fd_budget(concurrency), host_count * len(ports)))]
+    try:
+        remaining = len(workers)
+        while remaining:
+            result = await results.get()
+            if result is done:
+                remaining -= 1
+            else:
+                yield result
+        for task in workers:
+            if task.exception():
+                raise task.exception()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def scan_hosts(targets, services_to_scan=None, port_range=None, timeout=0.5,
+               concurrency=1000, per_host=100, callback=None):
+    """
+    Run scan_stream to completion, callback is called with every ScanResult
+    as it arrives, returns the open (host, port) pairs.
+    ['127.0.0.1'], port_range='22,80' -> [('127.0.0.1', 22)]
+    """
+    async def run():
+        open_ports = []
+        async for result in scan_stream(targets, services_to_scan,
+                                        port_range, timeout, concurrency,
+                                        per_host):
+            if callback:
+                callback(result)
+            if result.open:
+                open_ports.append((result.host, result.port))
+        return open_ports
+    return asyncio.run(run())
+
+
+class RateLimiter:
+    """
+    Spread calls evenly at a maximum rate per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        delay = self.next_time - now
+        self.next_time = max(self.next_time, now) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def host_intervals(targets):
+    """
+    Expand targets into (version, first, count) blocks and hostnames so a
+    host can be addressed by its position without building the host list.
+    """
+    if isinstance(targets, str):
+        targets = targets.split(',')
+    blocks = []
+    for target in targets:
+        try:
+            version, first, last = subnet_calculator.target2interval(target)
+            blocks.append((version, first, last - first + 1))
+        except ValueError:
+            blocks.append((0, target.strip(), 1))
+    return blocks
+
+
+def host_at(blocks, offsets, position):
+    block = bisect_left(offsets, position + 1) - 1
+    version, first, count = blocks[block]
+    if not version:
+        return first
+    return subnet_calculator.int2address(version, first + position -
+                                         offsets[block])
+
+
+def scan_plan(targets, ports, seed=None, workers=None, batch_size=4096,
+              rate=10000, timeout=0.5, concurrency=512):
+    """
+    Describe a sharded scan: hosts as blocks, ports and a seeded
+    pseudo-random permutation (i * a + c) % total of the (host, port) work
+    items, which is enough to rebuild and resume the scan order.
+    """
+    blocks = host_intervals(targets)
+    offsets = [0] + list(accumulate(count for _, _, count in blocks))
+    total = offsets[-1] * len(ports)
+    rng = random.Random(seed)
+    multiplier = rng.randrange(1, max(total, 2)) | 1
+    while total and gcd(multiplier, total) != 1:
+        multiplier = rng.randrange(1, total)
+    return {'blocks': blocks, 'offsets': offsets, 'ports': list(ports),
+            'total': total, 'multiplier': multiplier,
+            'increment': rng.randrange(max(total, 1)), 'seed': seed,
+            'workers': workers or os.cpu_count() or 1,
+            'batch_size': batch_size, 'rate': rate, 'timeout': timeout,
+            'concurrency': concurrency}
+
+
+def plan_item(plan, position):
+    item = (position * plan['multiplier'] + plan['increment']) % plan['total']
+    host, port = divmod(item, len(plan['ports']))
+    return host_at(plan['blocks'], plan['offsets'], host), plan['ports'][port]
+
+
+async def scan_shard(plan, worker, start_batch, output):
+    """
+    Scan the work items of one shard (every workers-th position) batch by
+    batch, each batch's results are put on the output queue once complete.
+    """
+    workers = plan['workers']
+    batch_span = plan['batch_size'] * workers
+    limiter = RateLimiter(plan['rate'] / workers)
+    limit = asyncio.Semaphore(fd_budget(plan['concurrency']))
+
+    async def scan_item(position):
+        host, port = plan_item(plan, position)
+        try:
+            async with limit:
+                await limiter.wait()
+                is_open = await probe(host, port, plan['timeout'])
+        except Exception:
+            logger.exception("Probe of %s:%s failed" % (host, port))
+            is_open = False
+        return ScanResult(host, port, 'tcp', is_open)
+
+    batch = start_batch
+    while batch * batch_span < plan['total']:
+        positions = range(batch * batch_span + worker,
+                          min((batch + 1) * batch_span, plan['total']),
+                          workers)
+        results = await asyncio.gather(*(scan_item(p) for p in positions))
+        output.put(('batch', worker, batch, results))
+        batch += 1
+    output.put(('done', worker, batch, []))
+
+
+def scan_shard_process(plan, worker, start_batch, output):
+    asyncio.run(scan_shard(plan, worker, start_batch, output))
+
+
+CHECKPOINT_KEYS = ('total', 'multiplier', 'increment', 'workers',
+                   'batch_size')
+
+
+def plan_digest(plan):
+    """
+    Digest of the hosts and ports of a scan plan, ties a checkpoint to the
+    targets it was written for.
+    """
+    return hashlib.sha256(json.dumps([plan['blocks'], plan['ports']])
+                          .encode()).hexdigest()
+
+
+def load_checkpoint(checkpoint, plan):
+    try:
+        with open(checkpoint, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if any(state.get(k) != plan[k] for k in CHECKPOINT_KEYS) or \
+            state.get('digest') != plan_digest(plan):
+        logger.info("Checkpoint %s does not match the scan, starting over"
+                    % checkpoint)
+        return {}
+    return {int(w): b for w, b in state['batches'].items()}
+
+
+def save_checkpoint(checkpoint, plan, batches):
+    state = {k: plan[k] for k in CHECKPOINT_KEYS}
+    state['digest'] = plan_digest(plan)
+    state['batches'] = batches
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def distributed_scan(targets, services_to_scan=None, port_range=None,
+                     workers=None, rate=10000, timeout=0.5, concurrency=512,
+                     checkpoint=None, seed=None, batch_size=4096,
+                     poll_interval=1.0):
+    """
+    Shard (host, port) work across a process pool, each worker running its
+    own asyncio scan loop at rate / workers probes per second, and yield the
+    merged ScanResult records. The work order is a seeded permutation so
+    consecutive probes hit different hosts, and with a checkpoint file
+    (and the same seed) an interrupted scan resumes from the last batch
+    completed by each worker. A worker process that dies raises
+    RuntimeError instead of stalling the scan.
+    distributed_scan('10.0.0.0/16', port_range='22,80,443', seed=1,
+                     checkpoint='scan.ckpt') -> ScanResult(...), ...
+    """
+    ports = select_ports(services_to_scan, port_range)
+    plan = scan_plan(targets, ports, seed, workers, batch_size, rate, timeout,
+                     concurrency)
+    if not plan['total']:
+        return
+    batches = load_checkpoint(checkpoint, plan) if checkpoint else {}
+    output = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=scan_shard_process,
+        args=(plan, worker, batches.get(worker, 0), output), daemon=True)
+        for worker in range(plan['workers'])]
+    for process in processes:
+        process.start()
+    try:
+        remaining = set(range(len(processes)))
+        while remaining:
+            try:
+                kind, worker, batch, results = output.get(
+                    timeout=poll_interval)
+            except queue.Empty:
+                for worker in remaining:
+                    exitcode = processes[worker].exitcode
+                    if exitcode is not None:
+                        raise RuntimeError("Scan worker %d exited with code "
+                                           "%d" % (worker, exitcode))
+                continue
+            if kind == 'done':
+                remaining.discard(worker)
+                continue
+            yield from results
+            batches[worker] = batch + 1
+            if checkpoint:
+                save_checkpoint(checkpoint, plan, batches)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+BANNER_PROBES = {
+    80: b"HEAD / HTTP/1.0\r\n\r\n",
+    443: b"",
+    8080: b"HEAD / HTTP/1.0\r\n\r\n",
+}
+GENERIC_PROBE = b"HEAD / HTTP/1.0\r\n\r\n"
+SIGNATURES = [
+    ('ssh', rb'^SSH-[\d.]+-(?P<ssh>[^\r\n]*)'),
+    ('ftp', rb'^220[- ](?P<ftp>[^\r\n]*FTP[^\r\n]*)'),
+    ('smtp', rb'^220[- ](?P<smtp>[^\r\n]*(?:SMTP|[Pp]ostfix|Exim)[^\r\n]*)'),
+    ('http', rb'^HTTP/[\d.]+ \d{3}[^\r\n]*\r\n'
+             rb'(?:(?:[^\r\n]+\r\n)*?[Ss]erver: (?P<http>[^\r\n]*))?'),
+    ('pop3', rb'^\+OK(?P<pop3>[^\r\n]*)'),
+    ('imap', rb'^\* OK(?P<imap>[^\r\n]*)'),
+    ('vnc', rb'^RFB (?P<vnc>\d{3}\.\d{3})'),
+    ('redis', rb'^-(?P<redis>(?:ERR|NOAUTH|DENIED)[^\r\n]*)'),
+    ('mysql', rb'^.{4}\x0a(?P<mysql>[\d.]+[^\x00]*)'),
+]
+SIGNATURES_RE = re.compile(b'|'.join(b'(?P<service_%s>%s)' % (name.encode(),
+                                                             pattern)
+                                     for name, pattern in SIGNATURES),
+                           re.DOTALL)
+
+
+def match_banner(banner):
+    """
+    Identify a service banner with the combined signature regex, returns
+    (service, product) or (None, None).
+    b'SSH-2.0-OpenSSH_8.9p1\r\n' -> ('ssh', 'OpenSSH_8.9p1')
+    """
+    match = SIGNATURES_RE.match(banner)
+    if not match:
+        return None, None
+    service_name = match.lastgroup[len('service_'):]
+    product = match.group(service_name) or b''
+    return service_name, product.decode('latin-1').strip()
+
+
+async def grab_banner(host, port, timeout=2.0, max_bytes=1024,
+                      wait=0.5):
+    """
+    Read at most max_bytes from an open port. Services that talk first are
+    read for up to wait seconds, otherwise the port's probe (an HTTP HEAD by
+    default) is sent and the answer read until timeout.
+    """
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, limit=max_bytes), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return b''
+    try:
+        try:
+            return await asyncio.wait_for(reader.read(max_bytes), wait)
+        except asyncio.TimeoutError:
+            pass
+        probe_data = BANNER_PROBES.get(port, GENERIC_PROBE)
+        if not probe_data:
+            return b''
+        writer.write(probe_data)
+        await writer.drain()
+        return await asyncio.wait_for(reader.read(max_bytes), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return b''
+    finally:
+        writer.close()
+
+
+async def fingerprint_stream(results, timeout=2.0, max_bytes=1024,
+                             concurrency=256):
+    """
+    Second scan stage, grab and match banners for the open ports of an
+    (async) iterable of ScanResult records, yields Fingerprint records as
+    they complete. Closed ports are dropped.
+    """
+    limit = asyncio.Semaphore(fd_budget(concurrency))
+    pending = set()
+
+    async def fingerprint(result):
+        async with limit:
+            banner = await grab_banner(result.host, result.port, timeout,
+                                       max_bytes)
+        service_name, product = match_banner(banner)
+        return Fingerprint(result.host, result.port, result.protocol,
+                           service_name, product,
+                           banner.decode('latin-1'))
+
+    async def items():
+        if hasattr(results, '__aiter__'):
+            async for result in results:
+                yield result
+        else:
+            for result in results:
+                yield result
+
+    async for result in items():
+        if result.open:
+            pending.add(asyncio.ensure_future(fingerprint(result)))
+        finished = {task for task in pending if task.done()}
+        for task in finished:
+            yield task.result()
+        pending -= finished
+    for task in asyncio.as_completed(pending):
+        yield await task
+
+
+def fingerprint_hosts(targets, services_to_scan=None, port_range=None,
+                      timeout=0.5, banner_timeout=2.0, concurrency=1000):
+    """
+    Scan targets and fingerprint the open ports, returns Fingerprint
+    records.
+    ['127.0.0.1'], port_range='22' -> [Fingerprint(host='127.0.0.1',
+        port=22, protocol='tcp', service='ssh', product='OpenSSH_8.9p1',
+        banner='SSH-2.0-OpenSSH_8.9p1\r\n')]
+    """
+    async def run():
+        scan = scan_stream(targets, services_to_scan, port_range, timeout,
+                           concurrency)
+        return [f async for f in fingerprint_stream(scan, banner_timeout)]
+    return asyncio.run(run())
+
 
-host="127.0.0.1"
-portscan(host)
+if __name__ == '__main__':
+    host = "127.0.0.1"
+    portscan(host)